@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+
+import database
+import metrics
+import repository
+
+logger = logging.getLogger(__name__)
+
+ACTIVITY_BUFFER_SIZE = int(os.getenv('ACTIVITY_BUFFER_SIZE', '50000'))
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', '1'))
+ACTIVITY_BATCH_SIZE = int(os.getenv('ACTIVITY_BATCH_SIZE', '5000'))
+
+# Fraction of events kept for noisy actions, e.g. "view_product=0.1,view_products=0.25".
+# Kept rows store their rate, so counts can be scaled back up when querying.
+def _parse_sample_rates(value):
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        action, _, rate = item.partition('=')
+        rates[action.strip()] = float(rate)
+    return rates
+
+SAMPLE_RATES = _parse_sample_rates(os.getenv('ACTIVITY_SAMPLE', 'view_products=0.1,view_product=0.25,main_menu=0.1'))
+
+# Activity events waiting for the writer: (timestamp, user_id, action, detail, sample_rate).
+# Bounded, so if the writer falls behind the oldest events are dropped.
+_buffer = deque(maxlen=ACTIVITY_BUFFER_SIZE)
+dropped = 0
+sampled_out = 0
+_task = None
+
+metrics.gauge('bot_activity_buffered', "Activity events waiting to be written", callback=lambda: len(_buffer))
+metrics.gauge('bot_activity_dropped', "Activity events dropped because the buffer was full", callback=lambda: dropped)
+metrics.gauge('bot_activity_sampled_out', "Activity events skipped by sampling", callback=lambda: sampled_out)
+
+# Record what a user did. Cheap enough for every handler: no formatting or I/O
+# happens here; detail is any JSON-serialisable value.
+def record(user_id, action, detail=None):
+    global dropped, sampled_out
+    rate = SAMPLE_RATES.get(action, 1.0)
+    if rate < 1.0 and random.random() >= rate:
+        sampled_out += 1
+        return
+    if len(_buffer) == _buffer.maxlen:
+        dropped += 1
+    _buffer.append((time.time(), user_id, action, detail, rate))
+
+async def flush():
+    global dropped
+    while _buffer:
+        batch = [_buffer.popleft() for _ in range(min(len(_buffer), ACTIVITY_BATCH_SIZE))]
+        try:
+            await repository.run(database.add_activity, batch)
+        except Exception as e:
+            # Put the batch back in front of newer events, as far as there is
+            # room; like a full buffer, this drops the oldest events
+            room = _buffer.maxlen - len(_buffer)
+            kept = batch[max(0, len(batch) - room):]
+            dropped += len(batch) - len(kept)
+            logger.error(f"Failed to write {len(batch)} activity events, {len(batch) - len(kept)} dropped: {e}")
+            _buffer.extendleft(reversed(kept))
+            return
+
+async def _writer():
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        await flush()
+
+def start():
+    global _task
+    if _task is None:
+        _task = asyncio.create_task(_writer())
+
+# Stop the writer and write whatever is still buffered
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+    await flush()
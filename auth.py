@@ -0,0 +1,81 @@
+import functools
+import os
+import time
+from collections import OrderedDict
+
+import repository
+import write_queue
+
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', '300'))
+
+_MISSING = object()
+
+# Bounded LRU of user rows with a TTL, so repeated taps skip the users table.
+# generation is bumped by every write, like the catalog's, so a row loaded
+# while a write was in flight isn't cached over it.
+class SessionCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return _MISSING
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id, user):
+        self._entries[user_id] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def discard(self, user_id):
+        self._entries.pop(user_id, None)
+        self.generation += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+sessions = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+async def get_user(user_id):
+    user = sessions.get(user_id)
+    if user is _MISSING:
+        generation = sessions.generation
+        user = await repository.get_user(user_id)
+        if generation == sessions.generation:
+            sessions.put(user_id, user)
+    return user
+
+async def add_user(user_id, phone_number):
+    await write_queue.add_user(user_id, phone_number)
+    sessions.discard(user_id)
+    sessions.put(user_id, (user_id, phone_number, 0))
+
+async def verify_user(user_id):
+    await write_queue.verify_user(user_id)
+    sessions.discard(user_id)
+
+def is_verified(user):
+    return bool(user and user[2])
+
+# Decorator for handlers that require a verified phone number
+def verified_only(handler):
+    @functools.wraps(handler)
+    async def wrapper(event, *args):
+        if not is_verified(await get_user(event.sender_id)):
+            await event.answer("Please verify your phone number first!")
+            return
+        return await handler(event, *args)
+    return wrapper
@@ -1,12 +1,33 @@
 import os
-import sqlite3
+import math
+import asyncio
 import random
 import string
 import logging
-from telethon import TelegramClient, events, Button
-from telethon.tl.types import InputMediaPhoto, InputMediaUploadedDocument
+import tempfile
+import functools
+from telethon import TelegramClient, Button
 from dotenv import load_dotenv
-from database import init_db, add_product, get_products, add_order, get_user_orders, add_user, verify_user, get_user, update_product, delete_product, add_news, get_news, get_all_users
+from database import init_db, ORDER_STATUSES
+import activity
+import auth
+from state_store import ConversationState, StateStore
+from router import Router, encode
+from ratelimit import RateLimiter, Policy, TokenBuckets, GLOBAL_RATE_LIMIT, GLOBAL_RATE_BURST
+from broadcast import BroadcastWorker
+import cart
+import catalog
+import catalog_io
+import media
+import media_store
+import metrics
+from outbox import Outbox, SCHEDULED_REQUESTS, OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_BURST
+import write_queue
+from repository import (
+    get_recent_orders, get_user_stats, get_orders_page, export_orders_csv, export_products as export_products_file,
+    get_news, get_user_activity, update_order_status, get_sales_by_status, get_top_products, get_daily_sales, rebuild_sales_rollups,
+    shutdown as shutdown_db,
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -28,238 +49,298 @@ if not all([API_ID, API_HASH, BOT_TOKEN]):
     logger.error("Missing required environment variables: API_ID, API_HASH, or BOT_TOKEN")
     raise ValueError("API_ID, API_HASH, and BOT_TOKEN must be set in environment variables")
 
+# TelegramClient that times every outbound API request
+class InstrumentedClient(TelegramClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Telegram's bot-wide limit is shared by all worker processes
+        self.outbox = Outbox(self._send, OUTBOX_GLOBAL_RATE / SHARD_COUNT, max(1.0, OUTBOX_GLOBAL_BURST / SHARD_COUNT))
+
+    # Sends and edits are rate limited and coalesced by the outbox; other requests go straight out
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        if isinstance(request, SCHEDULED_REQUESTS):
+            return await self.outbox.submit(request, ordered)
+        return await self._send(request, ordered, flood_sleep_threshold)
+
+    async def _send(self, request, ordered=False, flood_sleep_threshold=None):
+        return await metrics.track_request(super().__call__, request, ordered, flood_sleep_threshold)
+
+# In multi-process mode (see cluster.py) each worker process serves one shard of
+# users, with its own session and no update stream of its own
+BOT_SESSION = os.getenv('BOT_SESSION', 'bot')
+BOT_RECEIVE_UPDATES = os.getenv('BOT_RECEIVE_UPDATES', '1') == '1'
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0'))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
+
 # Initialize TelegramClient
-client = TelegramClient('bot', int(API_ID), API_HASH, base_logger=logger)
+client = InstrumentedClient(BOT_SESSION, int(API_ID), API_HASH, base_logger=logger, receive_updates=BOT_RECEIVE_UPDATES)
 
 # Initialize database
 init_db()
 
+# Background news delivery
+broadcaster = BroadcastWorker(client)
+
 # State management
-user_states = {}
+user_states = StateStore(shard=(SHARD_INDEX, SHARD_COUNT))
 STATE_PHONE = 'phone'
 STATE_OTP = 'otp'
 STATE_ADD_PRODUCT = 'add_product'
 STATE_EDIT_PRODUCT = 'edit_product'
 STATE_DELETE_PRODUCT = 'delete_product'
 STATE_ADD_NEWS = 'add_news'
+STATE_IMPORT_PRODUCTS = 'import_products'
+
+# Per-user tap limits in front of every handler; the admin is not limited.
+# Views are coalesced (only the latest tap is shown), actions with side effects are dropped.
+limiter = RateLimiter(
+    global_rate=GLOBAL_RATE_LIMIT / SHARD_COUNT, global_burst=max(1.0, GLOBAL_RATE_BURST / SHARD_COUNT), exempt=(ADMIN_ID,)
+)
+limiter.policies.update({
+    'products': Policy(1, 4, coalesce=True),
+    'product': Policy(2, 6, coalesce=True),
+    'cart': Policy(1, 4, coalesce=True),
+    'my_orders': Policy(1, 4, coalesce=True),
+    'news': Policy(0.5, 2, coalesce=True),
+    'add_to_cart': Policy(2, 6),
+    'checkout': Policy(0.2, 2),
+    '/start': Policy(0.5, 3),
+    '/search': Policy(1, 5),
+    'inline': Policy(2, 10),
+})
+
+# OTP guesses per user, separate from tap limits
+OTP_MAX_ATTEMPTS = int(os.getenv('OTP_MAX_ATTEMPTS', '5'))
+OTP_ATTEMPT_WINDOW = float(os.getenv('OTP_ATTEMPT_WINDOW', '300'))
+otp_attempts = TokenBuckets(OTP_MAX_ATTEMPTS / OTP_ATTEMPT_WINDOW, OTP_MAX_ATTEMPTS)
+
+# All updates go through one dispatcher
+router = Router(user_states, limiter)
+router.attach(client)
+
+metrics.gauge('bot_session_cache_hits', "Verified-user cache hits", callback=lambda: auth.sessions.hits)
+metrics.gauge('bot_session_cache_misses', "Verified-user cache misses", callback=lambda: auth.sessions.misses)
+metrics.gauge('bot_conversation_states', "Conversations in progress", callback=lambda: len(user_states))
+metrics.gauge('bot_rate_limit_buckets', "Per-user token buckets in memory", callback=lambda: len(limiter))
+
+ORDERS_PAGE_SIZE = 20
+MY_ORDERS_PAGE_SIZE = 10
 
 # Generate OTP
 def generate_otp(length=6):
     return ''.join(random.choices(string.digits, k=length))
 
-# Populate products (sample data with no media for safety)
-def populate_products():
-    products = [
-        ("iPhone 13", 799.99, "Latest iPhone, 128GB", None, None),
-        ("Samsung S23", 699.99, "Flagship Samsung phone", None, None),
-        ("MacBook Pro", 1299.99, "16GB RAM, 512GB SSD", None, None),
+# Populate products (sample data with no media for safety); only seeds an empty catalog
+SAMPLE_PRODUCTS = [
+    ("sample-iphone-13", "iPhone 13", 799.99, "Latest iPhone, 128GB", None, None),
+    ("sample-samsung-s23", "Samsung S23", 699.99, "Flagship Samsung phone", None, None),
+    ("sample-macbook-pro", "MacBook Pro", 1299.99, "16GB RAM, 512GB SSD", None, None),
+]
+
+async def populate_products():
+    count = await catalog.seed_products(SAMPLE_PRODUCTS)
+    if count:
+        logger.info(f"Seeded {count} sample products")
+
+# Decorator for admin-only callbacks
+def admin_only(handler):
+    @functools.wraps(handler)
+    async def wrapper(event, *args):
+        if event.sender_id != ADMIN_ID:
+            await event.answer("You are not an admin!")
+            logger.warning(f"User {event.sender_id} attempted admin action {handler.__name__}")
+            return
+        return await handler(event, *args)
+    return wrapper
+
+def main_menu(user_id):
+    keyboard = [
+        [Button.inline("Products", b"products"), Button.switch_inline("Search", same_peer=True)],
+        [Button.inline("Cart", b"cart")],
+        [Button.inline("My Orders", b"my_orders")],
+        [Button.inline("Profile", b"profile")],
+        [Button.inline("News", b"news")]
     ]
-    for product in products:
-        add_product(*product)
+    if user_id == ADMIN_ID:
+        keyboard.append([Button.inline("Admin Panel", b"admin_panel")])
+    return keyboard
 
 # /start command
-@client.on(events.NewMessage(pattern='/start'))
-async def start(event):
+@router.command('/start')
+async def start(event, argument):
     user_id = event.sender_id
-    user = get_user(user_id)
-    if user and user[2]:  # is_verified
-        keyboard = [
-            [Button.inline("Products", b"products")],
-            [Button.inline("My Orders", b"my_orders")],
-            [Button.inline("Profile", b"profile")],
-            [Button.inline("News", b"news")]
-        ]
-        if user_id == ADMIN_ID:
-            keyboard.append([Button.inline("Admin Panel", b"admin_panel")])
-        await event.reply("Welcome to our shop!", buttons=keyboard)
-        logger.info(f"Verified user {user_id} started the bot")
+    user = await auth.get_user(user_id)
+    if auth.is_verified(user):
+        await event.reply("Welcome to our shop!", buttons=main_menu(user_id))
+        activity.record(user_id, 'start')
     else:
-        user_states[user_id] = {'state': STATE_PHONE}
+        user_states.set(user_id, ConversationState(STATE_PHONE))
         await event.reply("Please enter your phone number (e.g., +998901234567):")
-        logger.info(f"User {user_id} prompted for phone number")
+        activity.record(user_id, 'verification_started')
 
-# Handle text messages (for phone and OTP)
-@client.on(events.NewMessage)
-async def handle_text(event):
+# Phone number step of verification
+@router.state(STATE_PHONE)
+async def enter_phone(event, conversation, text):
     user_id = event.sender_id
-    if user_id not in user_states:
-        return
-    state = user_states[user_id].get('state')
-    text = event.message.text.strip()
-
-    if state == STATE_PHONE:
-        if text.startswith('+') and len(text) >= 10:
-            add_user(user_id, text)
-            otp = generate_otp()
-            user_states[user_id] = {'state': STATE_OTP, 'otp': otp, 'phone': text}
-            await event.reply(f"OTP sent: {otp} (for demo, shown here). Enter the OTP:")
-            logger.info(f"OTP sent to user {user_id}")
-        else:
-            await event.reply("Invalid phone number. Please use format: +998901234567")
-    elif state == STATE_OTP:
-        if text == user_states[user_id]['otp']:
-            verify_user(user_id)
-            del user_states[user_id]
-            await event.reply("Verification successful! Use /start to continue.")
-            logger.info(f"User {user_id} verified")
-        else:
-            await event.reply("Invalid OTP. Try again:")
-    elif state == STATE_ADD_PRODUCT:
-        step = user_states[user_id].get('step', 'name')
-        if step == 'name':
-            user_states[user_id]['name'] = text
-            user_states[user_id]['step'] = 'price'
-            await event.reply("Enter product price (e.g., 99.99):")
-        elif step == 'price':
-            try:
-                price = float(text)
-                user_states[user_id]['price'] = price
-                user_states[user_id]['step'] = 'description'
-                await event.reply("Enter product description:")
-            except ValueError:
-                await event.reply("Invalid price. Enter a number (e.g., 99.99):")
-        elif step == 'description':
-            user_states[user_id]['description'] = text
-            user_states[user_id]['step'] = 'media'
-            await event.reply("Send an image or video (or type 'skip' to skip):")
-    elif state == STATE_EDIT_PRODUCT:
-        product_id = user_states[user_id]['product_id']
-        step = user_states[user_id].get('step', 'field')
-        if step == 'field':
-            if text in ['name', 'price', 'description', 'image', 'video']:
-                user_states[user_id]['field'] = text
-                user_states[user_id]['step'] = 'value'
-                await event.reply(f"Enter new {text} (for price, use number; for image/video, send media or URL):")
-            else:
-                await event.reply("Invalid field. Choose: name, price, description, image, video")
-        elif step == 'value':
-            field = user_states[user_id]['field']
-            if field == 'price':
-                try:
-                    value = float(text)
-                except ValueError:
-                    await event.reply("Invalid price. Enter a number:")
-                    return
-            else:
-                value = text
-            update_product(product_id, **{field: value})
-            del user_states[user_id]
-            await event.reply(f"Product {field} updated!", buttons=[[Button.inline("Back", b"admin_panel")]])
-            logger.info(f"Admin {user_id} updated product {product_id} {field}")
-    elif state == STATE_DELETE_PRODUCT:
-        try:
-            product_id = int(text)
-            delete_product(product_id)
-            del user_states[user_id]
-            await event.reply("Product deleted!", buttons=[[Button.inline("Back", b"admin_panel")]])
-            logger.info(f"Admin {user_id} deleted product {product_id}")
-        except ValueError:
-            await event.reply("Invalid product ID. Enter a number:")
-    elif state == STATE_ADD_NEWS:
-        add_news(text)
-        del user_states[user_id]
-        users = get_all_users()
-        for uid in users:
-            try:
-                await client.send_message(uid, f"News: {text}")
-            except Exception as e:
-                logger.error(f"Failed to send news to {uid}: {e}")
-        await event.reply("News posted and broadcasted!", buttons=[[Button.inline("Back", b"admin_panel")]])
-        logger.info(f"Admin {user_id} posted news: {text}")
-
-# Handle media for product creation
-@client.on(events.NewMessage(incoming=True))
-async def handle_media(event):
+    if text.startswith('+') and len(text) >= 10:
+        await auth.add_user(user_id, text)
+        otp = generate_otp()
+        user_states.set(user_id, ConversationState(STATE_OTP, otp=otp, phone=text))
+        await event.reply(f"OTP sent: {otp} (for demo, shown here). Enter the OTP:")
+        activity.record(user_id, 'otp_sent')
+    else:
+        await event.reply("Invalid phone number. Please use format: +998901234567")
+
+# OTP step of verification
+@router.state(STATE_OTP)
+async def enter_otp(event, conversation, text):
     user_id = event.sender_id
-    if user_id not in user_states or user_states[user_id].get('state') != STATE_ADD_PRODUCT:
+    wait = otp_attempts.take(user_id)
+    if wait:
+        await event.reply(f"Too many attempts. Try again in {math.ceil(wait)} seconds.")
+        logger.warning(f"User {user_id} is throttled on OTP attempts")
         return
-    if user_states[user_id].get('step') != 'media':
+    if text == conversation.otp:
+        await auth.verify_user(user_id)
+        user_states.pop(user_id)
+        await event.reply("Verification successful! Use /start to continue.")
+        activity.record(user_id, 'verified')
+    else:
+        await event.reply("Invalid OTP. Try again:")
+
+# Add product flow (admin): name -> price -> description -> media
+@router.state(STATE_ADD_PRODUCT, 'name')
+async def add_product_name(event, conversation, text):
+    conversation.name = text
+    conversation.step = 'price'
+    user_states.set(event.sender_id, conversation)
+    await event.reply("Enter product price (e.g., 99.99):")
+
+@router.state(STATE_ADD_PRODUCT, 'price')
+async def add_product_price(event, conversation, text):
+    try:
+        conversation.price = float(text)
+    except ValueError:
+        await event.reply("Invalid price. Enter a number (e.g., 99.99):")
         return
-    if event.message.text and event.message.text.lower() == 'skip':
-        add_product(
-            user_states[user_id]['name'],
-            user_states[user_id]['price'],
-            user_states[user_id]['description']
-        )
-        del user_states[user_id]
+    conversation.step = 'description'
+    user_states.set(event.sender_id, conversation)
+    await event.reply("Enter product description:")
+
+@router.state(STATE_ADD_PRODUCT, 'description')
+async def add_product_description(event, conversation, text):
+    conversation.description = text
+    conversation.step = 'media'
+    user_states.set(event.sender_id, conversation)
+    await event.reply("Send an image or video (or type 'skip' to skip):")
+
+@router.state(STATE_ADD_PRODUCT, 'media')
+async def add_product_media(event, conversation, text):
+    user_id = event.sender_id
+    if text.lower() == 'skip':
+        await catalog.add_product(conversation.name, conversation.price, conversation.description)
+        user_states.pop(user_id)
         await event.reply("Product added!", buttons=[[Button.inline("Back", b"admin_panel")]])
-        logger.info(f"Admin {user_id} added product without media")
+        activity.record(user_id, 'add_product', conversation.name)
         return
     if event.message.media:
         try:
-            file = await event.message.download_media()
+            file, _, _ = await media_store.save_message_media(event.message)
             if event.message.photo:
-                add_product(
-                    user_states[user_id]['name'],
-                    user_states[user_id]['price'],
-                    user_states[user_id]['description'],
-                    image_url=file
-                )
+                await catalog.add_product(conversation.name, conversation.price, conversation.description, image_url=file)
             elif event.message.video:
-                add_product(
-                    user_states[user_id]['name'],
-                    user_states[user_id]['price'],
-                    user_states[user_id]['description'],
-                    video_url=file
-                )
-            del user_states[user_id]
+                await catalog.add_product(conversation.name, conversation.price, conversation.description, video_url=file)
+            user_states.pop(user_id)
             await event.reply("Product added with media!", buttons=[[Button.inline("Back", b"admin_panel")]])
-            logger.info(f"Admin {user_id} added product with media")
+            activity.record(user_id, 'add_product', conversation.name)
         except Exception as e:
             logger.error(f"Failed to handle media for user {user_id}: {e}")
             await event.reply("Error processing media. Please try again or type 'skip'.")
+
+# Edit product flow (admin): field -> value
+EDITABLE_FIELDS = {'name': 'name', 'price': 'price', 'description': 'description', 'image': 'image_url', 'video': 'video_url'}
+
+@router.state(STATE_EDIT_PRODUCT, 'field')
+async def edit_product_field(event, conversation, text):
+    if text not in EDITABLE_FIELDS:
+        await event.reply("Invalid field. Choose: name, price, description, image, video")
+        return
+    conversation.field = text
+    conversation.step = 'value'
+    user_states.set(event.sender_id, conversation)
+    await event.reply(f"Enter new {text} (for price, use number; for image/video, send media or URL):")
+
+@router.state(STATE_EDIT_PRODUCT, 'value')
+async def edit_product_value(event, conversation, text):
+    user_id = event.sender_id
+    field = conversation.field
+    if field == 'price':
+        try:
+            value = float(text)
+        except ValueError:
+            await event.reply("Invalid price. Enter a number:")
             return
+    elif field in ('image', 'video') and event.message.media:
+        value, _, _ = await media_store.save_message_media(event.message)
+    else:
+        value = text
+    await catalog.update_product(conversation.product_id, **{EDITABLE_FIELDS[field]: value})
+    user_states.pop(user_id)
+    await event.reply(f"Product {field} updated!", buttons=[[Button.inline("Back", b"admin_panel")]])
+    activity.record(user_id, 'edit_product', [conversation.product_id, field])
 
-# Show products
-@client.on(events.CallbackQuery(data=b'products'))
-async def show_products(event):
-    user = get_user(event.sender_id)
-    if not user or not user[2]:
-        await event.answer("Please verify your phone number first!")
+# Delete product confirmation (admin)
+@router.state(STATE_DELETE_PRODUCT)
+async def delete_product_confirm(event, conversation, text):
+    user_id = event.sender_id
+    try:
+        product_id = int(text)
+    except ValueError:
+        await event.reply("Invalid product ID. Enter a number:")
         return
-    products = get_products()
-    keyboard = [[Button.inline(f"{p[1]} - ${p[2]}", f"product_{p[0]}")] for p in products]
-    keyboard.append([Button.inline("Back", b"back")])
+    await catalog.delete_product(product_id)
+    user_states.pop(user_id)
+    await event.reply("Product deleted!", buttons=[[Button.inline("Back", b"admin_panel")]])
+    activity.record(user_id, 'delete_product', product_id)
+
+# News content (admin)
+@router.state(STATE_ADD_NEWS)
+async def add_news_content(event, conversation, text):
+    user_id = event.sender_id
+    await write_queue.add_news(text)
+    user_states.pop(user_id)
+    broadcast_id = await broadcaster.submit(text, user_id)
+    await event.reply(f"News posted! Broadcast #{broadcast_id} is running, progress will be reported here.", buttons=[[Button.inline("Back", b"admin_panel")]])
+    activity.record(user_id, 'post_news', broadcast_id)
+
+# Show products
+@router.callback('products')
+@auth.verified_only
+async def show_products(event, *page):
+    direction, anchor = catalog.page_position(page)
+    keyboard = await catalog.page_keyboard('product', 'products', b"back", direction, anchor)
     await event.edit("Select a product:", buttons=keyboard)
-    logger.info(f"User {event.sender_id} viewed products")
+    activity.record(event.sender_id, 'view_products')
 
 # Product details
-@client.on(events.CallbackQuery(pattern=b'product_.*'))
-async def product_details(event):
+@router.callback('product')
+async def product_details(event, product_id):
     try:
-        product_id = int(event.data.decode().split('_')[1])
-        products = get_products()
-        product = next((p for p in products if p[0] == product_id), None)
+        product_id = int(product_id)
+        product = await catalog.get_product(product_id)
         if product:
-            name, price, description, image_url, video_url = product[1], product[2], product[3], product[4], product[5]
+            name, price, description = product[1], product[2], product[3]
             keyboard = [
-                [Button.inline("Add to Cart", f"add_to_cart_{product_id}")],
-                [Button.inline("Back", b"products")]
+                [Button.inline("Add to Cart", encode('add_to_cart', product_id))],
+                [Button.inline("View Cart", b"cart"), Button.inline("Back", b"products")]
             ]
-            media = None
-            if image_url and os.path.exists(image_url):
-                try:
-                    uploaded_file = await client.upload_file(image_url)
-                    media = InputMediaUploadedDocument(file=uploaded_file, mime_type='image/jpeg')
-                except Exception as e:
-                    logger.error(f"Failed to upload image for product {product_id}: {e}")
-            elif video_url and os.path.exists(video_url):
-                try:
-                    uploaded_file = await client.upload_file(video_url)
-                    media = InputMediaUploadedDocument(file=uploaded_file, mime_type='video/mp4')
-                except Exception as e:
-                    logger.error(f"Failed to upload video for product {product_id}: {e}")
-            elif image_url and image_url.startswith(('http://', 'https://')):
-                media = InputMediaPhoto(image_url)
-            elif video_url and video_url.startswith(('http://', 'https://')):
-                media = InputMediaUploadedDocument(file=video_url, mime_type='video/mp4')
-
-            await event.edit(
+            await media.edit_with_media(
+                event,
+                product,
                 f"**{name}**\nPrice: ${price}\nDescription: {description}",
-                buttons=keyboard,
-                file=media
+                keyboard
             )
-            logger.info(f"User {event.sender_id} viewed product {product_id}")
+            activity.record(event.sender_id, 'view_product', product_id)
         else:
             await event.answer("Product not found!")
     except Exception as e:
@@ -267,55 +348,139 @@ async def product_details(event):
         await event.answer("Error displaying product. Please try again.")
         await show_products(event)
 
+SEARCH_RESULTS = int(os.getenv('SEARCH_RESULTS', '10'))
+INLINE_RESULTS = int(os.getenv('INLINE_RESULTS', '20'))
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '60'))
+
+# /search <words> lists matching products as buttons
+@router.command('/search')
+async def search_command(event, argument):
+    if not auth.is_verified(await auth.get_user(event.sender_id)):
+        await event.reply("Please verify your phone number first!")
+        return
+    if not argument:
+        await event.reply("Usage: /search <words>")
+        return
+    products = await catalog.search(argument, SEARCH_RESULTS)
+    if not products:
+        await event.reply("No products found.", buttons=[[Button.inline("Products", b"products")]])
+        return
+    keyboard = [[Button.inline(f"{p[1]} - ${p[2]}", encode('product', p[0]))] for p in products]
+    await event.reply(f"Results for \"{argument}\":", buttons=keyboard)
+    activity.record(event.sender_id, 'search', [argument, len(products)])
+
+# Inline mode: @bot <words> in any chat
+@router.inline
+async def inline_search(event, query):
+    if not auth.is_verified(await auth.get_user(event.sender_id)):
+        await event.answer([], cache_time=0, private=True, switch_pm="Verify your phone number", switch_pm_param="start")
+        return
+    products = await catalog.search(query, INLINE_RESULTS) if query else []
+    results = [
+        event.builder.article(
+            title=f"{p[1]} - ${p[2]}",
+            description=p[3],
+            id=str(p[0]),
+            text=f"**{p[1]}**\nPrice: ${p[2]}\nDescription: {p[3]}",
+        )
+        for p in products
+    ]
+    await event.answer(results, cache_time=INLINE_CACHE_TIME)
+
 # Add to cart
-@client.on(events.CallbackQuery(pattern=b'add_to_cart_.*'))
-async def add_to_cart(event):
-    product_id = int(event.data.decode().split('_')[3])
+@router.callback('add_to_cart')
+@auth.verified_only
+async def add_to_cart(event, product_id, origin=None):
+    product_id = int(product_id)
     user_id = event.sender_id
-    add_order(user_id, product_id, 1)
-    await event.answer("Product added to cart!")
-    await show_products(event)
-    logger.info(f"User {user_id} added product {product_id} to cart")
+    quantity = await cart.add(user_id, product_id)
+    if quantity is None:
+        await event.answer("Product not found!")
+        return
+    if origin == 'cart':
+        await show_cart(event)
+    else:
+        await event.answer(f"Added to cart ({quantity} in cart)")
+    activity.record(user_id, 'add_to_cart', product_id)
 
-# My orders
-@client.on(events.CallbackQuery(data=b'my_orders'))
-async def my_orders(event):
+# Cart
+@router.callback('cart')
+@auth.verified_only
+async def show_cart(event):
+    text, keyboard = await cart.render(event.sender_id)
+    await event.edit(text, buttons=keyboard)
+    activity.record(event.sender_id, 'view_cart')
+
+@router.callback('cart_remove')
+@auth.verified_only
+async def remove_from_cart(event, product_id):
+    await cart.remove(event.sender_id, int(product_id))
+    await show_cart(event)
+
+@router.callback('cart_clear')
+@auth.verified_only
+async def clear_cart(event):
+    await cart.clear(event.sender_id)
+    await show_cart(event)
+    activity.record(event.sender_id, 'clear_cart')
+
+@router.callback('checkout')
+@auth.verified_only
+async def checkout(event):
     user_id = event.sender_id
-    user = get_user(user_id)
-    if not user or not user[2]:
-        await event.answer("Please verify your phone number first!")
+    count = await cart.checkout(user_id)
+    if not count:
+        await event.answer("Your cart is empty!")
         return
-    orders = get_user_orders(user_id)
+    await event.edit(
+        f"Order placed! {count} item(s) are now pending.",
+        buttons=[[Button.inline("My Orders", b"my_orders")], [Button.inline("Back", b"back")]]
+    )
+    activity.record(user_id, 'checkout', count)
+
+# My orders
+@router.callback('my_orders')
+@auth.verified_only
+async def my_orders(event, before_id=0):
+    user_id = event.sender_id
+    before_id = int(before_id)
+    orders = await get_recent_orders(user_id, before_id, MY_ORDERS_PAGE_SIZE + 1)
     if not orders:
         await event.edit("You have no orders!", buttons=[[Button.inline("Back", b"back")]])
         return
+    has_more = len(orders) > MY_ORDERS_PAGE_SIZE
+    orders = orders[:MY_ORDERS_PAGE_SIZE]
     text = "Your orders:\n"
     for order in orders:
         text += f"Order #{order[0]}: {order[1]} - ${order[2]} x {order[3]} ({order[4]}) on {order[5]}\n"
-    await event.edit(text, buttons=[[Button.inline("Back", b"back")]])
-    logger.info(f"User {user_id} viewed their orders")
+    nav = []
+    if before_id:
+        nav.append(Button.inline("« Newest", b"my_orders"))
+    if has_more:
+        nav.append(Button.inline("Older »", encode('my_orders', orders[-1][0])))
+    keyboard = [nav] if nav else []
+    keyboard.append([Button.inline("Back", b"back")])
+    await event.edit(text, buttons=keyboard)
+    activity.record(user_id, 'view_my_orders')
 
 # User profile
-@client.on(events.CallbackQuery(data=b'profile'))
+@router.callback('profile')
+@auth.verified_only
 async def profile(event):
     user_id = event.sender_id
-    user = get_user(user_id)
-    if not user or not user[2]:
-        await event.answer("Please verify your phone number first!")
-        return
-    orders = get_user_orders(user_id)
-    text = f"**Profile**\nPhone: {user[1]}\nVerified: Yes\nTotal Orders: {len(orders)}"
+    user = await auth.get_user(user_id)
+    order_count, total_spent, last_order_at = await get_user_stats(user_id)
+    text = f"**Profile**\nPhone: {user[1]}\nVerified: Yes\nTotal Orders: {order_count}\nTotal Spent: ${total_spent:.2f}"
+    if last_order_at:
+        text += f"\nLast Order: {last_order_at}"
     await event.edit(text, buttons=[[Button.inline("Back", b"back")]])
-    logger.info(f"User {user_id} viewed their profile")
+    activity.record(user_id, 'view_profile')
 
 # News
-@client.on(events.CallbackQuery(data=b'news'))
+@router.callback('news')
+@auth.verified_only
 async def show_news(event):
-    user = get_user(event.sender_id)
-    if not user or not user[2]:
-        await event.answer("Please verify your phone number first!")
-        return
-    news = get_news()
+    news = await get_news()
     if not news:
         await event.edit("No news available!", buttons=[[Button.inline("Back", b"back")]])
         return
@@ -323,138 +488,312 @@ async def show_news(event):
     for n in news:
         text += f"{n[2]}: {n[1]}\n"
     await event.edit(text, buttons=[[Button.inline("Back", b"back")]])
-    logger.info(f"User {event.sender_id} viewed news")
+    activity.record(event.sender_id, 'view_news')
 
 # Admin panel
-@client.on(events.CallbackQuery(data=b'admin_panel'))
+@router.callback('admin_panel')
+@admin_only
 async def admin_panel(event):
-    if event.sender_id != ADMIN_ID:
-        await event.answer("You are not an admin!")
-        logger.warning(f"User {event.sender_id} attempted to access admin panel")
-        return
     keyboard = [
-        [Button.inline("View Orders", b"view_orders")],
+        [Button.inline("View Orders", b"view_orders"), Button.inline("Analytics", b"analytics")],
         [Button.inline("Add Product", b"add_product")],
         [Button.inline("Edit Product", b"edit_product")],
         [Button.inline("Delete Product", b"delete_product")],
+        [Button.inline("Import Products", b"import_products")],
+        [Button.inline("Export CSV", b"export_products:csv"), Button.inline("Export JSON", b"export_products:json")],
         [Button.inline("Add News", b"add_news")],
         [Button.inline("Back", b"back")]
     ]
     await event.edit("Admin Panel:", buttons=keyboard)
-    logger.info(f"Admin {event.sender_id} accessed admin panel")
+    activity.record(event.sender_id, 'admin_panel')
 
-# View all orders (admin)
-@client.on(events.CallbackQuery(data=b'view_orders'))
-async def view_orders(event):
-    if event.sender_id != ADMIN_ID:
-        await event.answer("You are not an admin!")
-        return
-    conn = sqlite3.connect('shop.db')
-    c = conn.cursor()
-    c.execute("SELECT o.id, p.name, p.price, o.quantity, o.status, o.user_id, o.created_at FROM orders o JOIN products p ON o.product_id = p.id")
-    orders = c.fetchall()
-    conn.close()
+# Render one page of orders (newest first) with filter, paging and export buttons
+async def show_orders_page(respond, status='all', user_filter=0, before_id=0):
+    orders = await get_orders_page(
+        before_id, ORDERS_PAGE_SIZE + 1, None if status == 'all' else status, user_filter or None
+    )
+    has_more = len(orders) > ORDERS_PAGE_SIZE
+    orders = orders[:ORDERS_PAGE_SIZE]
+    keyboard = [[
+        Button.inline(f"[{s.title()}]" if s == status else s.title(), encode('view_orders', s, user_filter, 0))
+        for s in ('all',) + ORDER_STATUSES
+    ]]
+    nav = []
+    if before_id:
+        nav.append(Button.inline("« Newest", encode('view_orders', status, user_filter, 0)))
+    if has_more:
+        nav.append(Button.inline("Older »", encode('view_orders', status, user_filter, orders[-1][0])))
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([Button.inline("Export CSV", encode('export_orders', status, user_filter))])
+    keyboard.append([Button.inline("Back", b"admin_panel")])
     if not orders:
-        await event.edit("No orders found!", buttons=[[Button.inline("Back", b"admin_panel")]])
+        await respond("No orders found!", buttons=keyboard)
         return
-    text = "All orders:\n"
+    text = f"Orders ({status}{f', user {user_filter}' if user_filter else ''}):\n"
     for order in orders:
         text += f"Order #{order[0]}: {order[1]} - ${order[2]} x {order[3]} ({order[4]}) by User {order[5]} on {order[6]}\n"
-    await event.edit(text, buttons=[[Button.inline("Back", b"admin_panel")]])
-    logger.info(f"Admin {event.sender_id} viewed all orders")
+    await respond(text, buttons=keyboard)
 
-# Add product (admin)
-@client.on(events.CallbackQuery(data=b'add_product'))
-async def add_product_start(event):
+# View orders (admin)
+@router.callback('view_orders')
+@admin_only
+async def view_orders(event, status='all', user_filter=0, before_id=0):
+    await show_orders_page(event.edit, status, int(user_filter), int(before_id))
+    activity.record(event.sender_id, 'view_orders', [status, int(user_filter), int(before_id)])
+
+# /orders <user_id> shows one user's orders (admin)
+@router.command('/orders')
+async def orders_command(event, argument):
     if event.sender_id != ADMIN_ID:
-        await event.answer("You are not an admin!")
         return
-    user_states[event.sender_id] = {'state': STATE_ADD_PRODUCT, 'step': 'name'}
-    await event.reply("Enter product name:")
-    logger.info(f"Admin {event.sender_id} started adding product")
+    user_filter = int(argument) if argument.isdigit() else 0
+    await show_orders_page(event.reply, 'all', user_filter)
+    activity.record(event.sender_id, 'view_orders', ['all', user_filter, 0])
 
-# Edit product (admin)
-@client.on(events.CallbackQuery(data=b'edit_product'))
-async def edit_product_start(event):
+# /order_status <order_id> <status> (admin)
+@router.command('/order_status')
+async def order_status_command(event, argument):
     if event.sender_id != ADMIN_ID:
-        await event.answer("You are not an admin!")
         return
-    products = get_products()
-    keyboard = [[Button.inline(f"{p[1]} - ${p[2]}", f"edit_select_{p[0]}")] for p in products]
-    keyboard.append([Button.inline("Back", b"admin_panel")])
-    await event.edit("Select product to edit:", buttons=keyboard)
-    logger.info(f"Admin {event.sender_id} started editing product")
+    parts = argument.split()
+    if len(parts) != 2 or not parts[0].isdigit() or parts[1] not in ORDER_STATUSES:
+        await event.reply(f"Usage: /order_status <order_id> <{'|'.join(ORDER_STATUSES)}>")
+        return
+    if await update_order_status(int(parts[0]), parts[1]):
+        await event.reply(f"Order {parts[0]} is now {parts[1]}.")
+        activity.record(event.sender_id, 'order_status', [int(parts[0]), parts[1]])
+    else:
+        await event.reply(f"Order {parts[0]} not found.")
+
+# /activity <user_id> shows a user's recent actions (admin); sampled actions may be missing
+ACTIVITY_PAGE_SIZE = 20
 
-@client.on(events.CallbackQuery(pattern=b'edit_select_.*'))
-async def edit_product_select(event):
+@router.command('/activity')
+async def activity_command(event, argument):
     if event.sender_id != ADMIN_ID:
-        await event.answer("You are not an admin!")
         return
-    product_id = int(event.data.decode().split('_')[2])
-    user_states[event.sender_id] = {'state': STATE_EDIT_PRODUCT, 'product_id': product_id, 'step': 'field'}
-    await event.reply("Which field to edit? (name, price, description, image, video)")
-    logger.info(f"Admin {event.sender_id} selected product {product_id} for editing")
+    if not argument.isdigit():
+        await event.reply("Usage: /activity <user_id>")
+        return
+    await activity.flush()
+    events = await get_user_activity(int(argument), ACTIVITY_PAGE_SIZE)
+    if not events:
+        await event.reply(f"No activity recorded for user {argument}.")
+        return
+    text = f"**Recent activity of user {argument}:**\n"
+    for created_at, action, detail in events:
+        text += f"{created_at} {action}" + (f" {detail}" if detail is not None else "") + "\n"
+    await event.reply(text)
 
-# Delete product (admin)
-@client.on(events.CallbackQuery(data=b'delete_product'))
-async def delete_product_start(event):
+# Sales analytics from the rollup tables (admin)
+ANALYTICS_TOP_PRODUCTS = 10
+ANALYTICS_DAYS = 14
+
+@router.callback('analytics')
+@admin_only
+async def analytics(event, view='status'):
+    if view == 'products':
+        text = "**Top products by revenue** (excluding cancelled):\n"
+        for product_id, name, orders, units, revenue in await get_top_products(ANALYTICS_TOP_PRODUCTS):
+            name = name or ("Deleted products" if product_id == 0 else f"Product {product_id}")
+            text += f"{name}: ${revenue:.2f}, {units} units, {orders} orders\n"
+    elif view == 'days':
+        text = f"**Last {ANALYTICS_DAYS} days** (excluding cancelled):\n"
+        for day, orders, units, revenue in await get_daily_sales(ANALYTICS_DAYS):
+            text += f"{day}: ${revenue:.2f}, {units} units, {orders} orders\n"
+    else:
+        view = 'status'
+        text = "**Sales by status:**\n"
+        for status, orders, units, revenue in await get_sales_by_status():
+            text += f"{status.title()}: ${revenue:.2f}, {units} units, {orders} orders\n"
+    keyboard = [
+        [Button.inline(f"[{title}]" if key == view else title, encode('analytics', key))
+         for key, title in (('status', "By Status"), ('products', "Products"), ('days', "Daily"))],
+        [Button.inline("Back", b"admin_panel")],
+    ]
+    await event.edit(text, buttons=keyboard)
+    activity.record(event.sender_id, 'view_analytics', view)
+
+# /rebuild_analytics recomputes the rollups from all orders (admin)
+@router.command('/rebuild_analytics')
+async def rebuild_analytics_command(event, argument):
     if event.sender_id != ADMIN_ID:
-        await event.answer("You are not an admin!")
         return
-    products = get_products()
-    keyboard = [[Button.inline(f"{p[1]} - ${p[2]}", f"delete_select_{p[0]}")] for p in products]
-    keyboard.append([Button.inline("Back", b"admin_panel")])
-    await event.edit("Select product to delete:", buttons=keyboard)
-    logger.info(f"Admin {event.sender_id} started deleting product")
+    await rebuild_sales_rollups()
+    await event.reply("Sales analytics rebuilt.")
+    activity.record(event.sender_id, 'rebuild_analytics')
 
-@client.on(events.CallbackQuery(pattern=b'delete_select_.*'))
-async def delete_product_select(event):
-    if event.sender_id != ADMIN_ID:
-        await event.answer("You are not an admin!")
+# Export orders as CSV (admin)
+@router.callback('export_orders')
+@admin_only
+async def export_orders(event, status, user_filter):
+    await event.answer("Preparing export...")
+    fd, path = tempfile.mkstemp(prefix='orders_', suffix='.csv')
+    os.close(fd)
+    try:
+        count = await export_orders_csv(path, None if status == 'all' else status, int(user_filter) or None)
+        await client.send_file(event.chat_id, path, caption=f"Exported {count} orders", force_document=True)
+    finally:
+        os.remove(path)
+    activity.record(event.sender_id, 'export_orders', count)
+
+# Bulk import (admin): the next message should be a CSV or JSON document
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', str(20 * 1024 * 1024)))
+
+@router.callback('import_products')
+@admin_only
+async def import_products_start(event):
+    user_states.set(event.sender_id, ConversationState(STATE_IMPORT_PRODUCTS))
+    await event.reply(
+        "Send a CSV or JSON file of products. Columns: sku, name, price, description, image_url, video_url.\n"
+        "Existing products with the same sku are updated. Type 'cancel' to stop."
+    )
+    activity.record(event.sender_id, 'import_products_started')
+
+@router.state(STATE_IMPORT_PRODUCTS)
+async def import_products_file(event, conversation, text):
+    user_id = event.sender_id
+    if text.lower() == 'cancel':
+        user_states.pop(user_id)
+        await event.reply("Import cancelled.", buttons=[[Button.inline("Back", b"admin_panel")]])
+        return
+    if not event.message.document:
+        await event.reply("Please send the catalog as a CSV or JSON file, or type 'cancel'.")
         return
-    product_id = int(event.data.decode().split('_')[2])
-    user_states[event.sender_id] = {'state': STATE_DELETE_PRODUCT, 'product_id': product_id}
+    if event.message.file.size > IMPORT_MAX_BYTES:
+        await event.reply(f"File is too large (limit {IMPORT_MAX_BYTES // (1024 * 1024)} MB).")
+        return
+    fd, path = tempfile.mkstemp(prefix='import_', suffix=event.message.file.ext or '')
+    os.close(fd)
+    try:
+        await event.message.download_media(file=path)
+        rows, errors = await asyncio.get_running_loop().run_in_executor(None, catalog_io.read_products, path)
+    except (ValueError, UnicodeDecodeError) as e:
+        await event.reply(f"Could not read the file: {e}")
+        return
+    finally:
+        os.remove(path)
+    if errors:
+        await event.reply("Import rejected, nothing was changed:\n" + "\n".join(errors))
+        return
+    count = await catalog.import_products(rows)
+    user_states.pop(user_id)
+    await event.reply(f"Imported {count} products.", buttons=[[Button.inline("Back", b"admin_panel")]])
+    activity.record(user_id, 'import_products', count)
+
+# Export the catalog in the import format (admin)
+@router.callback('export_products')
+@admin_only
+async def export_products(event, fmt='csv'):
+    fmt = 'json' if fmt == 'json' else 'csv'
+    await event.answer("Preparing export...")
+    fd, path = tempfile.mkstemp(prefix='products_', suffix=f'.{fmt}')
+    os.close(fd)
+    try:
+        count = await export_products_file(path, fmt)
+        await client.send_file(event.chat_id, path, caption=f"Exported {count} products", force_document=True)
+    finally:
+        os.remove(path)
+    activity.record(event.sender_id, 'export_products', count)
+
+# Add product (admin)
+@router.callback('add_product')
+@admin_only
+async def add_product_start(event):
+    user_states.set(event.sender_id, ConversationState(STATE_ADD_PRODUCT, step='name'))
+    await event.reply("Enter product name:")
+    activity.record(event.sender_id, 'add_product_started')
+
+# Edit product (admin)
+@router.callback('edit_product')
+@admin_only
+async def edit_product_start(event, *page):
+    direction, anchor = catalog.page_position(page)
+    keyboard = await catalog.page_keyboard('edit_select', 'edit_product', b"admin_panel", direction, anchor)
+    await event.edit("Select product to edit:", buttons=keyboard)
+    activity.record(event.sender_id, 'edit_product_started')
+
+@router.callback('edit_select')
+@admin_only
+async def edit_product_select(event, product_id):
+    product_id = int(product_id)
+    user_states.set(event.sender_id, ConversationState(STATE_EDIT_PRODUCT, product_id=product_id, step='field'))
+    await event.reply("Which field to edit? (name, price, description, image, video)")
+    activity.record(event.sender_id, 'edit_product_selected', product_id)
+
+# Delete product (admin)
+@router.callback('delete_product')
+@admin_only
+async def delete_product_start(event, *page):
+    direction, anchor = catalog.page_position(page)
+    keyboard = await catalog.page_keyboard('delete_select', 'delete_product', b"admin_panel", direction, anchor)
+    await event.edit("Select product to delete:", buttons=keyboard)
+    activity.record(event.sender_id, 'delete_product_started')
+
+@router.callback('delete_select')
+@admin_only
+async def delete_product_select(event, product_id):
+    product_id = int(product_id)
+    user_states.set(event.sender_id, ConversationState(STATE_DELETE_PRODUCT, product_id=product_id))
     await event.reply("Enter the product ID to confirm deletion:")
-    logger.info(f"Admin {event.sender_id} selected product {product_id} for deletion")
+    activity.record(event.sender_id, 'delete_product_selected', product_id)
 
 # Add news (admin)
-@client.on(events.CallbackQuery(data=b'add_news'))
+@router.callback('add_news')
+@admin_only
 async def add_news_start(event):
-    if event.sender_id != ADMIN_ID:
-        await event.answer("You are not an admin!")
-        return
-    user_states[event.sender_id] = {'state': STATE_ADD_NEWS}
+    user_states.set(event.sender_id, ConversationState(STATE_ADD_NEWS))
     await event.reply("Enter news content:")
-    logger.info(f"Admin {event.sender_id} started adding news")
+    activity.record(event.sender_id, 'post_news_started')
 
 # Back button
-@client.on(events.CallbackQuery(data=b'back'))
+@router.callback('back')
+@auth.verified_only
 async def back(event):
-    user = get_user(event.sender_id)
-    if not user or not user[2]:
-        await event.answer("Please verify your phone number first!")
-        return
-    keyboard = [
-        [Button.inline("Products", b"products")],
-        [Button.inline("My Orders", b"my_orders")],
-        [Button.inline("Profile", b"profile")],
-        [Button.inline("News", b"news")]
-    ]
-    if event.sender_id == ADMIN_ID:
-        keyboard.append([Button.inline("Admin Panel", b"admin_panel")])
-    await event.edit("Welcome back!", buttons=keyboard)
-    logger.info(f"User {event.sender_id} returned to main menu")
+    await event.edit("Welcome back!", buttons=main_menu(event.sender_id))
+    activity.record(event.sender_id, 'main_menu')
 
 # Main function
+_background_tasks = []
+
+# Connect and start background services. Seeding and broadcasts run in only
+# one process; other processes follow catalog changes through the database.
+async def start_services():
+    await client.start(bot_token=BOT_TOKEN)
+    if SHARD_INDEX == 0:
+        await populate_products()
+    await user_states.start()
+    await metrics.start()
+    activity.start()
+    if SHARD_INDEX == 0:
+        broadcaster.start()
+    if SHARD_COUNT > 1:
+        _background_tasks.append(asyncio.create_task(catalog.watch_version()))
+
+async def stop_services():
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    await broadcaster.stop()
+    await user_states.stop()
+    await metrics.stop()
+    await client.outbox.stop()
+    await write_queue.stop()
+    await activity.stop()
+    media_store.shutdown()
+    shutdown_db()
+
 async def main():
     try:
-        await client.start(bot_token=BOT_TOKEN)
-        populate_products()
+        await start_services()
         logger.info("Bot started successfully")
         await client.run_until_disconnected()
     except Exception as e:
         logger.error(f"Bot crashed: {e}")
         raise
+    finally:
+        await stop_services()
 
 # Start the bot
 if __name__ == '__main__':
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import os
+
+import outbox
+import repository
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '5'))
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))  # messages per second
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '100'))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '30'))
+BROADCAST_POLL_INTERVAL = float(os.getenv('BROADCAST_POLL_INTERVAL', '5'))  # jobs submitted by other processes
+
+# Background worker that delivers persisted broadcast jobs. Recipients are read
+# from the users table in user_id order one batch at a time, and each batch's
+# results are committed together with the cursor, so a restart resumes the job
+# from the last committed batch. Its sends go out at background priority, so
+# the outbox serves interactive replies first and handles flood waits.
+class BroadcastWorker:
+    def __init__(self, client):
+        self.client = client
+        self._wake = asyncio.Event()
+        self._task = None
+        self._next_slot = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, content, admin_id):
+        broadcast_id = await repository.create_broadcast(content, admin_id)
+        self._wake.set()
+        return broadcast_id
+
+    async def _run(self):
+        outbox.priority.set(outbox.BACKGROUND)
+        while True:
+            self._wake.clear()
+            try:
+                jobs = await repository.get_running_broadcasts()
+                for job in jobs:
+                    await self._process(*job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Broadcast worker error: {e}")
+                await asyncio.sleep(5)
+                continue
+            if not jobs:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), BROADCAST_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _process(self, broadcast_id, content, admin_id, cursor, sent, failed):
+        logger.info(f"Broadcast {broadcast_id} running from user {cursor}")
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        last_report = loop.time()
+        while True:
+            batch = await repository.get_broadcast_batch(broadcast_id, cursor, BROADCAST_BATCH_SIZE)
+            if not batch:
+                break
+            pending = [user_id for user_id, status in batch if status is None]
+            deliveries = await asyncio.gather(*(self._deliver(user_id, content, semaphore) for user_id in pending))
+            cursor = batch[-1][0]
+            await repository.record_broadcast_batch(broadcast_id, deliveries, cursor)
+            batch_sent = sum(1 for d in deliveries if d[1] == 'sent')
+            sent += batch_sent
+            failed += len(deliveries) - batch_sent
+            if loop.time() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                last_report = loop.time()
+                await self._report(admin_id, f"Broadcast #{broadcast_id} in progress: {sent} sent, {failed} failed")
+        sent, failed = await repository.finish_broadcast(broadcast_id)
+        logger.info(f"Broadcast {broadcast_id} finished: {sent} sent, {failed} failed")
+        await self._report(admin_id, f"Broadcast #{broadcast_id} finished: {sent} sent, {failed} failed")
+
+    async def _deliver(self, user_id, content, semaphore):
+        async with semaphore:
+            await self._pace()
+            try:
+                await self.client.send_message(user_id, f"News: {content}")
+                return (user_id, 'sent', None)
+            except Exception as e:
+                logger.error(f"Failed to send news to {user_id}: {e}")
+                return (user_id, 'failed', str(e))
+
+    async def _pace(self):
+        # Hand out evenly spaced send slots
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1 / BROADCAST_RATE
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _report(self, admin_id, text):
+        try:
+            await self.client.send_message(admin_id, text)
+        except Exception as e:
+            logger.error(f"Failed to report broadcast progress to {admin_id}: {e}")
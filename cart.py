@@ -0,0 +1,40 @@
+from telethon import Button
+
+import repository
+import router
+import write_queue
+
+# Add quantity of a product, returning the new quantity in the cart (None if the product is gone)
+async def add(user_id, product_id, quantity=1):
+    return await write_queue.add_to_cart(user_id, product_id, quantity)
+
+async def remove(user_id, product_id):
+    await repository.remove_from_cart(user_id, product_id)
+
+async def clear(user_id):
+    await repository.clear_cart(user_id)
+
+# Place one order per cart line and empty the cart; returns the number of orders
+async def checkout(user_id):
+    return await repository.checkout_cart(user_id)
+
+# Cart contents as message text and keyboard
+async def render(user_id):
+    items = await repository.get_cart(user_id)
+    if not items:
+        return "Your cart is empty!", [[Button.inline("Products", b"products")], [Button.inline("Back", b"back")]]
+    text = "**Your cart:**\n"
+    total = 0
+    keyboard = []
+    for product_id, name, price, quantity in items:
+        subtotal = price * quantity
+        total += subtotal
+        text += f"{name} - ${price} x {quantity} = ${subtotal:.2f}\n"
+        keyboard.append([
+            Button.inline(f"✖ {name}", router.encode('cart_remove', product_id)),
+            Button.inline("➕", router.encode('add_to_cart', product_id, 'cart')),
+        ])
+    text += f"\nTotal: ${total:.2f}"
+    keyboard.append([Button.inline("Checkout", b"checkout"), Button.inline("Clear", b"cart_clear")])
+    keyboard.append([Button.inline("Back", b"back")])
+    return text, keyboard
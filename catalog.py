@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import os
+import re
+from collections import OrderedDict
+
+from telethon import Button
+
+import repository
+import router
+
+CATALOG_PAGE_SIZE = int(os.getenv('CATALOG_PAGE_SIZE', '10'))
+CATALOG_CACHE_SIZE = int(os.getenv('CATALOG_CACHE_SIZE', '1000'))
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '256'))
+CATALOG_SYNC_INTERVAL = float(os.getenv('CATALOG_SYNC_INTERVAL', '1'))
+
+logger = logging.getLogger(__name__)
+
+# Recently seen products by id, plus pages and their rendered keyboards.
+# Pages are keyed by ('next', after_id) or ('prev', before_id), matching the
+# keyset queries used to load them, and are kept coherent by the write helpers below.
+_products = OrderedDict()
+_pages = {}
+_keyboards = {}
+_searches = OrderedDict()
+_generation = 0
+
+def _remember(product):
+    _products[product[0]] = product
+    _products.move_to_end(product[0])
+    while len(_products) > CATALOG_CACHE_SIZE:
+        _products.popitem(last=False)
+
+async def get_product(product_id):
+    product = _products.get(product_id)
+    if product is None:
+        generation = _generation
+        product = await repository.get_product(product_id)
+        # A write that landed while we were loading makes this row stale
+        if product and generation == _generation:
+            _remember(product)
+    else:
+        _products.move_to_end(product_id)
+    return product
+
+# Returns (products, has_prev, has_next) for one page of the catalog
+async def get_page(direction='next', anchor=0):
+    key = (direction, anchor)
+    page = _pages.get(key)
+    if page is not None:
+        return page
+    generation = _generation
+    if direction == 'prev':
+        rows = await repository.get_products_before(anchor, CATALOG_PAGE_SIZE + 1)
+        if not rows:
+            return await get_page()
+        page = (rows[-CATALOG_PAGE_SIZE:], len(rows) > CATALOG_PAGE_SIZE, True)
+    else:
+        rows = await repository.get_products_after(anchor, CATALOG_PAGE_SIZE + 1)
+        page = (rows[:CATALOG_PAGE_SIZE], anchor > 0, len(rows) > CATALOG_PAGE_SIZE)
+    if generation == _generation:
+        _pages[key] = page
+        for product in page[0]:
+            _remember(product)
+    return page
+
+# Inline keyboard for one catalog page: item buttons call item_action with the
+# product id, navigation buttons call page_action with 'n'/'p' and the anchor id
+async def page_keyboard(item_action, page_action, back, direction='next', anchor=0):
+    key = (item_action, direction, anchor)
+    keyboard = _keyboards.get(key)
+    if keyboard is None:
+        generation = _generation
+        products, has_prev, has_next = await get_page(direction, anchor)
+        keyboard = [[Button.inline(f"{p[1]} - ${p[2]}", router.encode(item_action, p[0]))] for p in products]
+        nav = []
+        if products and has_prev:
+            nav.append(Button.inline("« Prev", router.encode(page_action, 'p', products[0][0])))
+        if products and has_next:
+            nav.append(Button.inline("Next »", router.encode(page_action, 'n', products[-1][0])))
+        if nav:
+            keyboard.append(nav)
+        keyboard.append([Button.inline("Back", back)])
+        if generation == _generation:
+            _keyboards[key] = keyboard
+    return keyboard
+
+# Every word of the query must match as a prefix; words are quoted so user
+# input can never be parsed as FTS operators
+def _match_expression(query):
+    terms = re.findall(r'\w+', query.lower())
+    return ' '.join(f'"{term}"*' for term in terms[:8])
+
+# Products matching a search query, best match first; results are cached per query
+async def search(query, limit=10):
+    match = _match_expression(query)
+    if not match:
+        return []
+    key = (match, limit)
+    results = _searches.get(key)
+    if results is not None:
+        _searches.move_to_end(key)
+        return results
+    generation = _generation
+    results = await repository.search_products(match, limit)
+    if generation == _generation:
+        _searches[key] = results
+        while len(_searches) > SEARCH_CACHE_SIZE:
+            _searches.popitem(last=False)
+        for product in results:
+            _remember(product)
+    return results
+
+# Turn the ('n' | 'p', anchor) callback arguments into get_page arguments
+def page_position(args):
+    if len(args) == 2:
+        return ('prev' if args[0] == 'p' else 'next'), int(args[1])
+    return 'next', 0
+
+def _invalidate(product_id, pages=True):
+    global _generation
+    _generation += 1
+    _products.pop(product_id, None)
+    if pages:
+        _pages.clear()
+        _keyboards.clear()
+        _searches.clear()
+
+def _invalidate_all():
+    global _generation
+    _generation += 1
+    _products.clear()
+    _pages.clear()
+    _keyboards.clear()
+    _searches.clear()
+
+# Bulk upsert of validated (sku, name, price, description, image_url, video_url) rows
+async def import_products(rows):
+    count = await repository.upsert_products(rows)
+    _invalidate_all()
+    return count
+
+async def seed_products(rows):
+    count = await repository.seed_products(rows)
+    if count:
+        _invalidate_all()
+    return count
+
+async def add_product(name, price, description, image_url=None, video_url=None):
+    product_id = await repository.add_product(name, price, description, image_url, video_url)
+    _invalidate(product_id)
+    return product_id
+
+async def update_product(product_id, **fields):
+    await repository.update_product(product_id, **fields)
+    _invalidate(product_id)
+
+async def set_media_file_id(product_id, file_id):
+    await repository.set_product_media_file_id(product_id, file_id)
+    # Page keyboards only show names and prices
+    _invalidate(product_id, pages=False)
+
+async def delete_product(product_id):
+    await repository.delete_product(product_id)
+    _invalidate(product_id)
+
+# When several processes serve the bot, each one polls the shared catalog
+# version and drops its caches after another process changes products
+async def watch_version(interval=CATALOG_SYNC_INTERVAL):
+    version = await repository.get_catalog_version()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            current = await repository.get_catalog_version()
+        except Exception as e:
+            logger.error(f"Failed to read catalog version: {e}")
+            continue
+        if current != version:
+            version = current
+            _invalidate_all()
@@ -0,0 +1,72 @@
+import csv
+import json
+import os
+
+IMPORT_MAX_ROWS = int(os.getenv('IMPORT_MAX_ROWS', '50000'))
+MAX_ERRORS = 10
+
+# Validate one record; returns the row tuple for upsert_products or an error message
+def _validate(record):
+    sku = str(record.get('sku') or '').strip()
+    name = str(record.get('name') or '').strip()
+    if not sku:
+        return None, "missing sku"
+    if not name:
+        return None, "missing name"
+    if len(sku) > 64 or len(name) > 256:
+        return None, "sku or name too long"
+    try:
+        price = round(float(record.get('price')), 2)
+    except (TypeError, ValueError):
+        return None, f"invalid price {record.get('price')!r}"
+    if not 0 <= price < 1e9:
+        return None, f"price out of range {price}"
+    description = str(record.get('description') or '').strip()
+    image_url = str(record.get('image_url') or '').strip() or None
+    video_url = str(record.get('video_url') or '').strip() or None
+    return (sku, name, price, description, image_url, video_url), None
+
+def _records(path):
+    with open(path, encoding='utf-8-sig') as f:
+        head = f.read(64).lstrip()
+        f.seek(0)
+        if path.lower().endswith('.json') or head.startswith('['):
+            data = json.load(f)
+            if not isinstance(data, list):
+                raise ValueError("JSON import must be a list of products")
+            yield from data
+        else:
+            # csv.Error (oversized fields, NUL bytes before Python 3.11) is reported like any other bad file
+            try:
+                reader = csv.DictReader(f)
+                missing = {'sku', 'name', 'price'} - set(reader.fieldnames or ())
+                if missing:
+                    raise ValueError(f"CSV header is missing {', '.join(sorted(missing))}")
+                yield from reader
+            except csv.Error as e:
+                raise ValueError(f"invalid CSV: {e}") from e
+
+# Parse and validate a CSV or JSON catalog file. Returns (rows, errors); the
+# import should only be applied when errors is empty. Runs off the event loop.
+def read_products(path):
+    rows = []
+    errors = []
+    seen = {}
+    for number, record in enumerate(_records(path), start=1):
+        if number > IMPORT_MAX_ROWS:
+            errors.append(f"more than {IMPORT_MAX_ROWS} products")
+            break
+        if not isinstance(record, dict):
+            errors.append(f"row {number}: not an object")
+            continue
+        row, error = _validate(record)
+        if error is None and row[0] in seen:
+            error = f"duplicate sku {row[0]!r} (also row {seen[row[0]]})"
+        if error is not None:
+            errors.append(f"row {number}: {error}")
+            if len(errors) >= MAX_ERRORS:
+                break
+            continue
+        seen[row[0]] = number
+        rows.append(row)
+    return rows, errors
@@ -0,0 +1,200 @@
+"""Multi-process mode: one process receives Telegram updates and forwards them
+to BOT_WORKERS handler processes, sharded by sender so each user's updates
+are handled in order by the same process.
+
+    BOT_WORKERS=4 python cluster.py
+
+Workers share the SQLite database; catalog caches follow writes from other
+processes through the catalog version (see catalog.watch_version).
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+
+from dotenv import load_dotenv
+from telethon import TelegramClient, events, types, utils
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', str(os.cpu_count() or 1)))
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', '10000'))
+WORKER_STOP_TIMEOUT = float(os.getenv('WORKER_STOP_TIMEOUT', '30'))
+WORKER_MAX_RESTARTS = int(os.getenv('WORKER_MAX_RESTARTS', '5'))
+WORKER_CHECK_INTERVAL = float(os.getenv('WORKER_CHECK_INTERVAL', '5'))
+WORKER_PUT_TIMEOUT = 1.0  # how often a forward blocked on a full queue rechecks its worker
+
+# User the update comes from, used to pick its worker
+def sender_of(update):
+    user_id = getattr(update, 'user_id', None)
+    if user_id is not None:
+        return user_id
+    message = getattr(update, 'message', None)
+    peer = getattr(message, 'from_id', None) or getattr(message, 'peer_id', None)
+    if peer is not None:
+        return utils.get_peer_id(peer)
+    return 0
+
+# Worker process: import the bot with this shard's settings and handle the
+# updates the receiver forwards, one user at a time in arrival order
+def run_worker(index, count, updates):
+    os.environ.update({
+        'BOT_SESSION': f"bot-worker-{index}",
+        'BOT_RECEIVE_UPDATES': '0',
+        'SHARD_INDEX': str(index),
+        'SHARD_COUNT': str(count),
+    })
+    port = int(os.getenv('METRICS_PORT', '9100'))
+    if port:
+        os.environ['METRICS_PORT'] = str(port + 1 + index)
+    import bot
+    bot.client.loop.run_until_complete(_serve(bot, updates))
+
+async def _serve(bot, updates):
+    loop = asyncio.get_running_loop()
+    tails = {}  # sender -> task handling that sender's latest update
+    await bot.start_services()
+    logger.info(f"Worker {bot.SHARD_INDEX} of {bot.SHARD_COUNT} started")
+    try:
+        while True:
+            update = await loop.run_in_executor(None, updates.get)
+            if update is None:
+                break
+            entities = getattr(update, '_entities', {}).values()
+            bot.client._mb_entity_cache.extend(
+                [e for e in entities if isinstance(e, types.User)],
+                [e for e in entities if not isinstance(e, types.User)],
+            )
+            sender = sender_of(update)
+            task = loop.create_task(_dispatch(bot.client, update, tails.get(sender)))
+            tails[sender] = task
+            task.add_done_callback(lambda t, s=sender: tails.pop(s, None) if tails.get(s) is t else None)
+        await asyncio.gather(*tails.values(), return_exceptions=True)
+    finally:
+        await bot.stop_services()
+        await bot.client.disconnect()
+
+async def _dispatch(client, update, previous):
+    if previous is not None:
+        await asyncio.wait([previous])
+    await client._dispatch_update(update)
+
+# Receiver process: the only one with an update stream
+async def receive(workers):
+    import database
+    import metrics
+    database.init_db()
+    forwarded = metrics.counter('bot_cluster_updates_forwarded_total', "Updates forwarded to workers", ('worker',))
+    restarted = metrics.counter('bot_cluster_worker_restarts_total', "Worker processes restarted after exiting", ('worker',))
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(WORKER_QUEUE_SIZE) for _ in range(workers)]
+    processes = [None] * workers
+    restarts = [0] * workers
+
+    def start_worker(index):
+        processes[index] = context.Process(target=run_worker, args=(index, workers, queues[index]),
+                                           name=f"bot-worker-{index}")
+        processes[index].start()
+
+    for index in range(workers):
+        start_worker(index)
+
+    client = TelegramClient(os.getenv('BOT_SESSION', 'bot'), int(os.getenv('API_ID')), os.getenv('API_HASH'))
+    loop = asyncio.get_running_loop()
+
+    # Restart a worker that died, with a new queue: the dead process may still
+    # hold the old queue's read lock. Updates left in the old queue are lost.
+    # A worker that keeps dying stops the receiver instead of dropping its shard.
+    def check_worker(index):
+        process = processes[index]
+        if process.is_alive():
+            return
+        if restarts[index] >= WORKER_MAX_RESTARTS:
+            raise RuntimeError(f"Worker {index} exited with code {process.exitcode} after {restarts[index]} restarts")
+        restarts[index] += 1
+        restarted.inc(index)
+        logger.error(f"Worker {index} exited with code {process.exitcode}, restarting it; "
+                     f"{queues[index].qsize()} queued updates lost")
+        queues[index] = context.Queue(WORKER_QUEUE_SIZE)
+        start_worker(index)
+
+    async def stop_receiving(error):
+        logger.critical(f"{error}; stopping the receiver")
+        await client.disconnect()
+
+    async def monitor():
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            try:
+                for index in range(workers):
+                    check_worker(index)
+            except RuntimeError as e:
+                await stop_receiving(e)
+                return
+
+    # Updates are queued locally in arrival order, one queue per worker, and a
+    # single feeder per worker moves them to its process, so a full worker queue
+    # can't let a later update from the same user overtake an earlier one
+    pending = [asyncio.Queue() for _ in range(workers)]
+    metrics.gauge('bot_cluster_backlog', "Updates waiting for a worker",
+                  callback=lambda: sum(q.qsize() for q in queues) + sum(p.qsize() for p in pending))
+
+    async def forward(update):
+        pending[sender_of(update) % workers].put_nowait(update)
+
+    async def feed(index):
+        while True:
+            update = await pending[index].get()
+            while True:
+                target = queues[index]  # replaced when the worker is restarted
+                try:
+                    target.put_nowait(update)
+                    break
+                except queue.Full:
+                    pass
+                # Wait for room, rechecking the worker so a dead one can't block forever
+                try:
+                    check_worker(index)
+                except RuntimeError as e:
+                    await stop_receiving(e)
+                    return
+                if target is not queues[index]:
+                    continue
+                try:
+                    await loop.run_in_executor(None, target.put, update, True, WORKER_PUT_TIMEOUT)
+                except queue.Full:
+                    continue
+                if target is queues[index]:
+                    break
+                # The worker was restarted while this put waited; the old queue is gone
+            forwarded.inc(index)
+
+    client.add_event_handler(forward, events.Raw())
+    tasks = [asyncio.create_task(monitor())] + [asyncio.create_task(feed(i)) for i in range(workers)]
+    try:
+        await client.start(bot_token=os.getenv('BOT_TOKEN'))
+        await metrics.start()
+        logger.info(f"Receiver forwarding updates to {workers} workers")
+        await client.run_until_disconnected()
+    finally:
+        for task in tasks:
+            task.cancel()
+        for q in queues:
+            try:
+                q.put(None, timeout=WORKER_PUT_TIMEOUT)
+            except queue.Full:
+                pass  # the worker is stuck or dead; it is terminated below
+        for process in processes:
+            await loop.run_in_executor(None, process.join, WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        await metrics.stop()
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s')
+    asyncio.run(receive(BOT_WORKERS))
+
+if __name__ == '__main__':
+    main()
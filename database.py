@@ -1,38 +1,118 @@
+import csv
+import json
+import os
 import sqlite3
+import threading
+
+import migrations
+
+DB_PATH = os.getenv('DB_PATH', 'shop.db')
+ORDER_STATUSES = ('pending', 'completed', 'cancelled')
+PRODUCT_FIELDS = ('sku', 'name', 'price', 'description', 'image_url', 'video_url')
+
+# Statements that can go through the batched write queue (see write_queue.py).
+# add_user upserts rather than INSERT OR REPLACE, whose implicit delete would
+# cascade to the user's orders and cart.
+WRITE_STATEMENTS = {
+    # Returns the new quantity, or no row when the product no longer exists
+    'add_to_cart': """INSERT INTO cart_items (user_id, product_id, quantity) SELECT ?1, id, ?3 FROM products WHERE id = ?2
+                      ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity
+                      RETURNING quantity""",
+    'add_user': """INSERT INTO users (user_id, phone_number, is_verified) VALUES (?, ?, 0)
+                   ON CONFLICT (user_id) DO UPDATE SET phone_number = excluded.phone_number, is_verified = 0""",
+    'verify_user': "UPDATE users SET is_verified = 1 WHERE user_id = ?",
+    'add_news': "INSERT INTO news (content) VALUES (?)",
+}
+
+# Product name and price as shown on an order: the price recorded when it was
+# placed, and orders of deleted products (product_id set to NULL) are kept
+ORDER_PRODUCT_COLUMNS = "COALESCE(p.name, 'Deleted product'), COALESCE(o.unit_price, 0)"
+
+# One long-lived connection per thread; sqlite3 caches prepared statements per connection
+_local = threading.local()
+_trace_callback = None
+
+# Install a statement trace callback on every connection opened afterwards (profiling)
+def set_trace_callback(callback):
+    global _trace_callback
+    _trace_callback = callback
+
+def get_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=5, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL makes NORMAL durable across application crashes; only power loss can drop the last commits
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("PRAGMA cache_size=-16000")  # 16 MB page cache
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if _trace_callback:
+            conn.set_trace_callback(_trace_callback)
+        _local.conn = conn
+    return conn
+
+# Run a database function, rolling back whatever transaction it left open if it
+# fails; the thread's connection outlives the call and would keep the write lock
+def call(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        conn = getattr(_local, 'conn', None)
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+        raise
 
 def init_db():
-    conn = sqlite3.connect('shop.db')
-    c = conn.cursor()
-    # Create tables
-    c.execute('''CREATE TABLE IF NOT EXISTS products
-                 (id INTEGER PRIMARY KEY, name TEXT, price REAL, description TEXT, image_url TEXT, video_url TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS orders
-                 (id INTEGER PRIMARY KEY, user_id INTEGER, product_id INTEGER, quantity INTEGER, status TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (user_id INTEGER PRIMARY KEY, phone_number TEXT, is_verified INTEGER DEFAULT 0)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS news
-                 (id INTEGER PRIMARY KEY, content TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    # Check and add video_url column if missing
-    c.execute("PRAGMA table_info(products)")
-    columns = [col[1] for col in c.fetchall()]
-    if 'video_url' not in columns:
-        c.execute("ALTER TABLE products ADD COLUMN video_url TEXT")
-        print("Added video_url column to products table")
-    
-    conn.commit()
-    conn.close()
+    migrations.migrate(get_connection())
 
 def add_product(name, price, description, image_url=None, video_url=None):
-    conn = sqlite3.connect('shop.db')
+    conn = get_connection()
     c = conn.cursor()
     c.execute("INSERT INTO products (name, price, description, image_url, video_url) VALUES (?, ?, ?, ?, ?)",
               (name, price, description, image_url, video_url))
     conn.commit()
-    conn.close()
+    return c.lastrowid
+
+# Insert or update products keyed by sku, all in one transaction. Changing the
+# image or video drops the cached Telegram file id, as update_product does.
+def upsert_products(products):
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        c.executemany('''INSERT INTO products (sku, name, price, description, image_url, video_url)
+                         VALUES (?, ?, ?, ?, ?, ?)
+                         ON CONFLICT (sku) WHERE sku IS NOT NULL DO UPDATE SET
+                             name = excluded.name, price = excluded.price, description = excluded.description,
+                             media_file_id = CASE WHEN image_url IS excluded.image_url AND video_url IS excluded.video_url
+                                                  THEN media_file_id END,
+                             image_url = excluded.image_url, video_url = excluded.video_url''', products)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(products)
+
+# Insert the given products only into an empty catalog; returns how many were added
+def seed_products(products):
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT EXISTS (SELECT 1 FROM products)")
+        if c.fetchone()[0]:
+            conn.rollback()
+            return 0
+        c.executemany("INSERT INTO products (sku, name, price, description, image_url, video_url) VALUES (?, ?, ?, ?, ?, ?)",
+                      products)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(products)
 
 def update_product(product_id, name=None, price=None, description=None, image_url=None, video_url=None):
-    conn = sqlite3.connect('shop.db')
+    conn = get_connection()
     c = conn.cursor()
     updates = []
     values = []
@@ -51,86 +131,431 @@ def update_product(product_id, name=None, price=None, description=None, image_ur
     if video_url:
         updates.append("video_url = ?")
         values.append(video_url)
+    if image_url or video_url:
+        # New media invalidates the Telegram reference of the old file
+        updates.append("media_file_id = NULL")
     if updates:
         values.append(product_id)
         query = f"UPDATE products SET {', '.join(updates)} WHERE id = ?"
         c.execute(query, values)
         conn.commit()
-    conn.close()
 
 def delete_product(product_id):
-    conn = sqlite3.connect('shop.db')
+    conn = get_connection()
     c = conn.cursor()
     c.execute("DELETE FROM products WHERE id = ?", (product_id,))
     conn.commit()
-    conn.close()
 
 def get_products():
-    conn = sqlite3.connect('shop.db')
+    conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT * FROM products")
     products = c.fetchall()
-    conn.close()
     return products
 
-def add_order(user_id, product_id, quantity):
-    conn = sqlite3.connect('shop.db')
+def add_media_file(sha256, path, mime_type, size):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("INSERT OR IGNORE INTO media_files (sha256, path, mime_type, size) VALUES (?, ?, ?, ?)",
+              (sha256, path, mime_type, size))
+    conn.commit()
+
+def get_media_file_by_path(path):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT sha256, path, mime_type, size, thumb_path FROM media_files WHERE path = ?", (path,))
+    media_file = c.fetchone()
+    return media_file
+
+def set_media_thumbnail(sha256, thumb_path):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("UPDATE media_files SET thumb_path = ? WHERE sha256 = ?", (thumb_path, sha256))
+    conn.commit()
+
+def get_products_after(after_id, limit):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT * FROM products WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit))
+    products = c.fetchall()
+    return products
+
+def get_products_before(before_id, limit):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT * FROM products WHERE id < ? ORDER BY id DESC LIMIT ?", (before_id, limit))
+    products = c.fetchall()
+    products.reverse()
+    return products
+
+def get_product(product_id):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT * FROM products WHERE id = ?", (product_id,))
+    product = c.fetchone()
+    return product
+
+# Ranked full-text search; matches in the name weigh more than in the description
+def search_products(match, limit):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('''SELECT p.* FROM products_fts f JOIN products p ON p.id = f.rowid
+                 WHERE products_fts MATCH ? ORDER BY bm25(products_fts, 10.0, 1.0), p.id LIMIT ?''',
+              (match, limit))
+    products = c.fetchall()
+    return products
+
+def get_catalog_version():
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT version FROM catalog_version WHERE id = 1")
+    version = c.fetchone()[0]
+    return version
+
+def set_product_media_file_id(product_id, file_id):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("UPDATE products SET media_file_id = ? WHERE id = ?", (file_id, product_id))
+    conn.commit()
+
+# Returns False when there is no such order
+def update_order_status(order_id, status):
+    if status not in ORDER_STATUSES:
+        raise ValueError(f"Unknown order status {status!r}")
+    conn = get_connection()
     c = conn.cursor()
-    c.execute("INSERT INTO orders (user_id, product_id, quantity, status) VALUES (?, ?, ?, ?)",
-              (user_id, product_id, quantity, 'pending'))
+    c.execute("UPDATE orders SET status = ? WHERE id = ? AND status != ?", (status, order_id, status))
     conn.commit()
-    conn.close()
+    if c.rowcount:
+        return True
+    c.execute("SELECT EXISTS (SELECT 1 FROM orders WHERE id = ?)", (order_id,))
+    return bool(c.fetchone()[0])
+
+def add_to_cart(user_id, product_id, quantity=1):
+    # Returns the new quantity, or None when the product no longer exists
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(WRITE_STATEMENTS['add_to_cart'], (user_id, product_id, quantity))
+    row = c.fetchone()
+    conn.commit()
+    return row[0] if row else None
+
+def remove_from_cart(user_id, product_id):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("DELETE FROM cart_items WHERE user_id = ? AND product_id = ?", (user_id, product_id))
+    conn.commit()
+
+def clear_cart(user_id):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("DELETE FROM cart_items WHERE user_id = ?", (user_id,))
+    conn.commit()
+
+def get_cart(user_id):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("""SELECT ci.product_id, p.name, p.price, ci.quantity FROM cart_items ci
+                 JOIN products p ON p.id = ci.product_id WHERE ci.user_id = ? ORDER BY ci.rowid""",
+              (user_id,))
+    items = c.fetchall()
+    return items
+
+def checkout_cart(user_id):
+    # Turn every cart line into a pending order and empty the cart in one transaction
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        c.execute("""INSERT INTO orders (user_id, product_id, quantity, status, unit_price)
+                     SELECT ci.user_id, ci.product_id, ci.quantity, 'pending', p.price
+                     FROM cart_items ci JOIN products p ON p.id = ci.product_id
+                     WHERE ci.user_id = ? ORDER BY ci.rowid""",
+                  (user_id,))
+        count = c.rowcount
+        c.execute("DELETE FROM cart_items WHERE user_id = ?", (user_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return count
 
 def get_user_orders(user_id):
-    conn = sqlite3.connect('shop.db')
+    conn = get_connection()
     c = conn.cursor()
-    c.execute("SELECT o.id, p.name, p.price, o.quantity, o.status, o.created_at FROM orders o JOIN products p ON o.product_id = p.id WHERE o.user_id = ?", (user_id,))
+    c.execute(f"SELECT o.id, {ORDER_PRODUCT_COLUMNS}, o.quantity, o.status, o.created_at FROM orders o LEFT JOIN products p ON o.product_id = p.id WHERE o.user_id = ?", (user_id,))
     orders = c.fetchall()
-    conn.close()
     return orders
 
+def get_recent_orders(user_id, before_id, limit):
+    # Newest first, continuing below before_id (0 starts from the newest order)
+    # The id bound is only added when set: an OR would stop SQLite using it as an index range
+    query = f"""SELECT o.id, {ORDER_PRODUCT_COLUMNS}, o.quantity, o.status, o.created_at FROM orders o
+                LEFT JOIN products p ON o.product_id = p.id WHERE o.user_id = ?"""
+    values = [user_id]
+    if before_id:
+        query += " AND o.id < ?"
+        values.append(before_id)
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(query + " ORDER BY o.id DESC LIMIT ?", values + [limit])
+    orders = c.fetchall()
+    return orders
+
+def get_user_stats(user_id):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT order_count, total_spent, last_order_at FROM user_stats WHERE user_id = ?", (user_id,))
+    stats = c.fetchone()
+    return stats or (0, 0, None)
+
 def add_user(user_id, phone_number):
-    conn = sqlite3.connect('shop.db')
+    conn = get_connection()
     c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO users (user_id, phone_number, is_verified) VALUES (?, ?, 0)",
-              (user_id, phone_number))
+    c.execute(WRITE_STATEMENTS['add_user'], (user_id, phone_number))
     conn.commit()
-    conn.close()
 
 def verify_user(user_id):
-    conn = sqlite3.connect('shop.db')
+    conn = get_connection()
     c = conn.cursor()
-    c.execute("UPDATE users SET is_verified = 1 WHERE user_id = ?", (user_id,))
+    c.execute(WRITE_STATEMENTS['verify_user'], (user_id,))
     conn.commit()
-    conn.close()
 
 def get_user(user_id):
-    conn = sqlite3.connect('shop.db')
+    conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
     user = c.fetchone()
-    conn.close()
     return user
 
 def add_news(content):
-    conn = sqlite3.connect('shop.db')
+    conn = get_connection()
     c = conn.cursor()
-    c.execute("INSERT INTO news (content) VALUES (?)", (content,))
+    c.execute(WRITE_STATEMENTS['add_news'], (content,))
     conn.commit()
-    conn.close()
+
+# Apply many queued writes in one transaction. Each write runs under its own
+# savepoint so a failing one is rolled back alone; returns, per write, the
+# exception it raised or the row its statement returned (None without RETURNING).
+def apply_writes(writes):
+    # writes are (name, args, context); each statement runs in the context of
+    # the caller that queued it, so tracing attributes it to that caller
+    conn = get_connection()
+    c = conn.cursor()
+    results = []
+    try:
+        c.execute("BEGIN")
+        for name, args, context in writes:
+            c.execute("SAVEPOINT write")
+            try:
+                context.run(c.execute, WRITE_STATEMENTS[name], args)
+                results.append(c.fetchone())
+            except sqlite3.Error as e:
+                c.execute("ROLLBACK TO write")
+                results.append(e)
+            c.execute("RELEASE write")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return results
 
 def get_news():
-    conn = sqlite3.connect('shop.db')
+    conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT * FROM news ORDER BY created_at DESC LIMIT 5")
     news = c.fetchall()
-    conn.close()
     return news
 
 def get_all_users():
-    conn = sqlite3.connect('shop.db')
+    conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT user_id FROM users")
     users = c.fetchall()
-    conn.close()
-    return [user[0] for user in users]
\ No newline at end of file
+    return [user[0] for user in users]
+
+def _orders_query(status=None, user_id=None, before_id=None):
+    query = f"SELECT o.id, {ORDER_PRODUCT_COLUMNS}, o.quantity, o.status, o.user_id, o.created_at FROM orders o LEFT JOIN products p ON o.product_id = p.id"
+    conditions = []
+    values = []
+    if before_id:
+        conditions.append("o.id < ?")
+        values.append(before_id)
+    if status:
+        conditions.append("o.status = ?")
+        values.append(status)
+    if user_id:
+        conditions.append("o.user_id = ?")
+        values.append(user_id)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return query + " ORDER BY o.id DESC", values
+
+def get_orders_page(before_id, limit, status=None, user_id=None):
+    # Newest first, continuing below before_id (0 starts from the newest order)
+    query, values = _orders_query(status, user_id, before_id)
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(query + " LIMIT ?", values + [limit])
+    orders = c.fetchall()
+    return orders
+
+def export_orders_csv(path, status=None, user_id=None, chunk_size=500):
+    # Stream the joined result set to a CSV file without loading it all
+    query, values = _orders_query(status, user_id)
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(query, values)
+    count = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['order_id', 'product', 'price', 'quantity', 'status', 'user_id', 'created_at'])
+        while True:
+            rows = c.fetchmany(chunk_size)
+            if not rows:
+                break
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+def export_products(path, fmt='csv', chunk_size=500):
+    # Stream the catalog to CSV or JSON in the format import accepts
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(f"SELECT {', '.join(PRODUCT_FIELDS)} FROM products ORDER BY id")
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(PRODUCT_FIELDS)
+        else:
+            f.write('[')
+        while True:
+            rows = c.fetchmany(chunk_size)
+            if not rows:
+                break
+            if fmt == 'csv':
+                writer.writerows(rows)
+            else:
+                for i, row in enumerate(rows):
+                    f.write((',\n' if count + i else '\n') + json.dumps(dict(zip(PRODUCT_FIELDS, row)), ensure_ascii=False))
+            count += len(rows)
+        if fmt != 'csv':
+            f.write('\n]\n')
+    return count
+
+# Sales analytics, read from the rollup tables maintained by triggers on orders
+def get_sales_by_status():
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("""SELECT status, SUM(order_count), SUM(units), SUM(revenue) FROM sales_by_product
+                 GROUP BY status ORDER BY status""")
+    rows = c.fetchall()
+    return rows
+
+def get_top_products(limit):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("""SELECT s.product_id, p.name, SUM(s.order_count), SUM(s.units), SUM(s.revenue)
+                 FROM sales_by_product s LEFT JOIN products p ON p.id = s.product_id
+                 WHERE s.status != 'cancelled'
+                 GROUP BY s.product_id HAVING SUM(s.order_count) > 0
+                 ORDER BY SUM(s.revenue) DESC LIMIT ?""", (limit,))
+    rows = c.fetchall()
+    return rows
+
+def get_daily_sales(days):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("""SELECT day, SUM(order_count), SUM(units), SUM(revenue) FROM sales_by_day
+                 WHERE status != 'cancelled' AND day >= date('now', ?)
+                 GROUP BY day ORDER BY day DESC""", (f"-{days - 1} days",))
+    rows = c.fetchall()
+    return rows
+
+def rebuild_sales_rollups():
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        migrations.fill_sales_rollups(c)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def add_activity(events):
+    # events are (created_at, user_id, action, detail, sample_rate); detail is serialised here, off the event loop
+    conn = get_connection()
+    c = conn.cursor()
+    c.executemany("INSERT INTO activity_log (created_at, user_id, action, detail, sample_rate) VALUES (?, ?, ?, ?, ?)",
+                  [(t, user_id, action, None if detail is None else json.dumps(detail), rate)
+                   for t, user_id, action, detail, rate in events])
+    conn.commit()
+
+def get_user_activity(user_id, limit):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("""SELECT datetime(created_at, 'unixepoch'), action, detail FROM activity_log
+                 WHERE user_id = ? ORDER BY id DESC LIMIT ?""", (user_id, limit))
+    events = c.fetchall()
+    return events
+
+def create_broadcast(content, admin_id):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("INSERT INTO broadcasts (content, admin_id) VALUES (?, ?)", (content, admin_id))
+    conn.commit()
+    return c.lastrowid
+
+def get_running_broadcasts():
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT id, content, admin_id, last_user_id, sent, failed FROM broadcasts WHERE status = 'running' ORDER BY id")
+    broadcasts = c.fetchall()
+    return broadcasts
+
+def get_broadcast_batch(broadcast_id, after_user_id, limit):
+    # Next slice of recipients by user_id, with any delivery already recorded for them
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("""SELECT u.user_id, d.status FROM users u
+                 LEFT JOIN broadcast_deliveries d ON d.broadcast_id = ? AND d.user_id = u.user_id
+                 WHERE u.user_id > ? ORDER BY u.user_id LIMIT ?""",
+              (broadcast_id, after_user_id, limit))
+    batch = c.fetchall()
+    return batch
+
+def record_broadcast_batch(broadcast_id, deliveries, last_user_id):
+    # Store per-recipient results and advance the cursor in one transaction
+    sent = sum(1 for d in deliveries if d[1] == 'sent')
+    conn = get_connection()
+    c = conn.cursor()
+    c.executemany("INSERT OR REPLACE INTO broadcast_deliveries (broadcast_id, user_id, status, error) VALUES (?, ?, ?, ?)",
+                  [(broadcast_id, user_id, status, error) for user_id, status, error in deliveries])
+    c.execute("UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, failed = failed + ? WHERE id = ?",
+              (last_user_id, sent, len(deliveries) - sent, broadcast_id))
+    conn.commit()
+
+def finish_broadcast(broadcast_id):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("UPDATE broadcasts SET status = 'done' WHERE id = ?", (broadcast_id,))
+    c.execute("SELECT sent, failed FROM broadcasts WHERE id = ?", (broadcast_id,))
+    totals = c.fetchone()
+    conn.commit()
+    return totals
+
+def load_conversation_states(now):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("DELETE FROM conversation_states WHERE expires_at < ?", (now,))
+    c.execute("SELECT user_id, data, expires_at FROM conversation_states ORDER BY expires_at")
+    states = c.fetchall()
+    conn.commit()
+    return states
+
+def save_conversation_states(upserts, deletes):
+    conn = get_connection()
+    c = conn.cursor()
+    c.executemany("INSERT OR REPLACE INTO conversation_states (user_id, data, expires_at) VALUES (?, ?, ?)", upserts)
+    c.executemany("DELETE FROM conversation_states WHERE user_id = ?", deletes)
+    conn.commit()
@@ -0,0 +1,362 @@
+"""Offline load test for the bot handlers.
+
+Drives simulated users through verification, browsing, the cart and order
+views, plus an admin news broadcast, against a temporary database using
+stand-in Telegram events and client. No network or Telegram account needed:
+
+    python loadtest.py --users 2000 --concurrency 100
+    python loadtest.py --pool          # database calls on the event loop against the pool
+    python loadtest.py --workers 4     # throughput with 1..4 worker processes
+"""
+import argparse
+import asyncio
+import contextvars
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+ADMIN_ID = 1
+
+# Stand-ins for the Telethon objects the handlers touch
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+        self.media = None
+        self.photo = None
+        self.video = None
+
+    async def download_media(self, *args, **kwargs):
+        return None
+
+class FakeEvent:
+    def __init__(self, sender_id, text=None, data=None):
+        self.sender_id = sender_id
+        self.chat_id = sender_id
+        self.data = data
+        self.message = FakeMessage(text) if text is not None else None
+        self.last_text = None
+
+    async def reply(self, text, **kwargs):
+        self.last_text = text
+
+    async def edit(self, text, **kwargs):
+        self.last_text = text
+        return True
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+class FakeClient:
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, entity, text, **kwargs):
+        self.sent += 1
+
+    async def send_file(self, entity, file, **kwargs):
+        self.sent += 1
+
+# Data statements (not pragmas or transaction control) run for the update being
+# recorded; repository.run carries this context variable into the pool threads
+_queries = contextvars.ContextVar('queries', default=None)
+
+def _trace(statement):
+    counter = _queries.get()
+    if counter is not None and statement.lstrip()[:6].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+        counter[0] += 1
+
+def setup(db_path):
+    os.environ.update({
+        'API_ID': '1', 'API_HASH': 'loadtest', 'BOT_TOKEN': 'loadtest',
+        'ADMIN_ID': str(ADMIN_ID), 'DB_PATH': db_path, 'BROADCAST_RATE': '100000',
+    })
+    import database
+    database.set_trace_callback(_trace)
+    import bot
+    fake = FakeClient()
+    bot.client = fake
+    bot.broadcaster.client = fake
+    # Simulated users tap with no think time; measure handler cost, not throttling
+    bot.router.limiter = None
+    return bot, fake
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(int)
+
+    async def run(self, name, handler, event):
+        counter = [0]
+        token = _queries.set(counter)
+        start = time.perf_counter()
+        try:
+            await handler(event)
+        finally:
+            self.latencies[name].append(time.perf_counter() - start)
+            _queries.reset(token)
+        self.queries[name] += counter[0]
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def simulate_user(bot, recorder, user_id, product_ids):
+    router = bot.router
+    await recorder.run('/start', router.on_message, FakeEvent(user_id, '/start'))
+    await recorder.run('phone', router.on_message, FakeEvent(user_id, f"+99890{user_id:07d}"))
+    otp = bot.user_states.get(user_id).otp
+    await recorder.run('otp', router.on_message, FakeEvent(user_id, otp))
+    await recorder.run('/start', router.on_message, FakeEvent(user_id, '/start'))
+    await recorder.run('products', router.on_callback, FakeEvent(user_id, data=b'products'))
+    for product_id in random.sample(product_ids, 3):
+        await recorder.run('product', router.on_callback, FakeEvent(user_id, data=f"product:{product_id}".encode()))
+        await recorder.run('add_to_cart', router.on_callback, FakeEvent(user_id, data=f"add_to_cart:{product_id}".encode()))
+    await recorder.run('cart', router.on_callback, FakeEvent(user_id, data=b'cart'))
+    await recorder.run('checkout', router.on_callback, FakeEvent(user_id, data=b'checkout'))
+    await recorder.run('my_orders', router.on_callback, FakeEvent(user_id, data=b'my_orders'))
+    await recorder.run('profile', router.on_callback, FakeEvent(user_id, data=b'profile'))
+    await recorder.run('back', router.on_callback, FakeEvent(user_id, data=b'back'))
+
+async def run_load(args):
+    bot, fake = setup(os.path.join(tempfile.mkdtemp(prefix='loadtest_'), 'shop.db'))
+    for i in range(args.products):
+        await bot.catalog.add_product(f"Product {i}", round(random.uniform(1, 2000), 2), f"Description {i}")
+    product_ids = [p[0] for p in (await bot.catalog.get_page('next', 0))[0]]
+
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(user_id):
+        async with semaphore:
+            await simulate_user(bot, recorder, user_id, product_ids)
+
+    bot.activity.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(one(ADMIN_ID + 1 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - start
+
+    # Admin news broadcast to every simulated user
+    await bot.user_states.start()
+    bot.broadcaster.start()
+    broadcast_start = time.perf_counter()
+    await recorder.run('add_news', bot.router.on_callback, FakeEvent(ADMIN_ID, data=b'add_news'))
+    await recorder.run('news_text', bot.router.on_message, FakeEvent(ADMIN_ID, 'Load test news'))
+    while fake.sent < args.users + 1:  # recipients plus the final report to the admin
+        await asyncio.sleep(0.01)
+    broadcast_elapsed = time.perf_counter() - broadcast_start
+    await bot.broadcaster.stop()
+    await bot.user_states.stop()
+
+    updates = sum(len(v) for v in recorder.latencies.values())
+    print(f"{args.users} users, concurrency {args.concurrency}, {args.products} products")
+    print(f"{updates} updates in {elapsed:.2f}s: {updates / elapsed:.0f} updates/s")
+    print(f"broadcast to {args.users} users: {broadcast_elapsed:.2f}s")
+    print(f"{'handler':<12} {'count':>7} {'p50 ms':>8} {'p99 ms':>8} {'queries':>8}")
+    all_latencies = []
+    for name, latencies in recorder.latencies.items():
+        all_latencies.extend(latencies)
+        print(f"{name:<12} {len(latencies):>7} {percentile(latencies, 0.5) * 1000:>8.2f} "
+              f"{percentile(latencies, 0.99) * 1000:>8.2f} {recorder.queries[name] / len(latencies):>8.2f}")
+    print(f"{'all':<12} {len(all_latencies):>7} {percentile(all_latencies, 0.5) * 1000:>8.2f} "
+          f"{percentile(all_latencies, 0.99) * 1000:>8.2f} {sum(recorder.queries.values()) / updates:>8.2f}")
+    await bot.activity.stop()
+    print(f"activity: {bot.activity.sampled_out} sampled out, {bot.activity.dropped} dropped")
+    await bot.write_queue.stop()
+    bot.shutdown_db()
+
+# Sustained write throughput: one commit per write against the group-commit queue
+async def run_writes(args):
+    bot, _ = setup(os.path.join(tempfile.mkdtemp(prefix='loadtest_'), 'shop.db'))
+    import database
+    import repository
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def direct(user_id):
+        async with semaphore:
+            await repository.run(database.add_user, user_id, f"+{user_id}")
+            await repository.run(database.verify_user, user_id)
+
+    async def queued(user_id):
+        async with semaphore:
+            await bot.write_queue.add_user(user_id, f"+{user_id}")
+            await bot.write_queue.verify_user(user_id)
+
+    for name, write, offset in (('direct', direct, 0), ('queued', queued, args.users)):
+        start = time.perf_counter()
+        await asyncio.gather(*(write(ADMIN_ID + 1 + offset + i) for i in range(args.users)))
+        elapsed = time.perf_counter() - start
+        print(f"{name:<8} {args.users * 2} writes in {elapsed:.2f}s: {args.users * 2 / elapsed:.0f} writes/s")
+    await bot.write_queue.stop()
+    bot.shutdown_db()
+
+# Handler throughput with database calls made on the event loop, as before the
+# repository layer (a new connection per call, then the long-lived one), against
+# the same calls through the repository pool. Each simulated update reads the
+# user and a product, adds it to the cart and reads the cart back.
+async def run_pool(args):
+    bot, _ = setup(os.path.join(tempfile.mkdtemp(prefix='loadtest_'), 'shop.db'))
+    import database
+    import repository
+    for i in range(args.products):
+        database.add_product(f"Product {i}", round(random.uniform(1, 2000), 2), f"Description {i}")
+    product_ids = [p[0] for p in database.get_products()]
+    user_ids = [ADMIN_ID + 1 + i for i in range(args.users)]
+    for user_id in user_ids:
+        database.add_user(user_id, f"+{user_id}")
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    def reconnecting(func):
+        def call(*call_args):
+            try:
+                return func(*call_args)
+            finally:
+                database.get_connection().close()
+                del database._local.conn
+        return call
+
+    async def sync_call(func, *call_args):
+        return func(*call_args)
+
+    modes = (
+        ('connect', lambda func, *a: sync_call(reconnecting(func), *a)),
+        ('direct', sync_call),
+        ('pool', repository.run),
+    )
+    for name, call in modes:
+        latencies = []
+
+        async def update(user_id):
+            async with semaphore:
+                start = time.perf_counter()
+                product_id = random.choice(product_ids)
+                await call(database.get_user, user_id)
+                await call(database.get_product, product_id)
+                await call(database.add_to_cart, user_id, product_id)
+                await call(database.get_cart, user_id)
+                latencies.append(time.perf_counter() - start)
+
+        # How late a 1 ms timer fires: how long other updates would wait for the loop
+        lags = []
+
+        async def ticker():
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lags.append(time.perf_counter() - start - 0.001)
+
+        ticking = asyncio.create_task(ticker())
+        start = time.perf_counter()
+        await asyncio.gather(*(update(user_id) for user_id in user_ids))
+        elapsed = time.perf_counter() - start
+        ticking.cancel()
+        print(f"{name:<8} {args.users} updates in {elapsed:.2f}s: {args.users / elapsed:.0f} updates/s, "
+              f"p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms, "
+              f"loop lag max {max(lags, default=elapsed) * 1000:.2f} ms")
+    await bot.write_queue.stop()
+    bot.shutdown_db()
+
+# One worker process of the multi-process benchmark: serves the users of its
+# shard (user_id % count == index) once every worker is ready
+def _shard_worker(db_path, index, count, user_ids, concurrency, barrier, results):
+    os.environ.update({'SHARD_INDEX': str(index), 'SHARD_COUNT': str(count), 'METRICS_PORT': '0'})
+    bot, _ = setup(db_path)
+
+    async def run():
+        product_ids = [p[0] for p in (await bot.catalog.get_page('next', 0))[0]]
+        recorder = Recorder()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(user_id):
+            async with semaphore:
+                await simulate_user(bot, recorder, user_id, product_ids)
+
+        bot.activity.start()
+        barrier.wait()
+        start = time.time()
+        await asyncio.gather(*(one(user_id) for user_id in user_ids if user_id % count == index))
+        results.put((sum(len(v) for v in recorder.latencies.values()), start, time.time()))
+        await bot.activity.stop()
+        await bot.write_queue.stop()
+        bot.shutdown_db()
+
+    asyncio.run(run())
+
+# Throughput against the number of worker processes sharing one database
+def run_workers(args):
+    db_path = os.path.join(tempfile.mkdtemp(prefix='loadtest_'), 'shop.db')
+    os.environ['METRICS_PORT'] = '0'
+    bot, _ = setup(db_path)
+
+    async def seed():
+        for i in range(args.products):
+            await bot.catalog.add_product(f"Product {i}", round(random.uniform(1, 2000), 2), f"Description {i}")
+        await bot.write_queue.stop()
+
+    asyncio.run(seed())
+    context = multiprocessing.get_context('spawn')
+    print(f"{args.users} users per run, concurrency {args.concurrency} per worker, {os.cpu_count()} CPUs")
+    for count in range(1, args.workers + 1):
+        user_ids = range(ADMIN_ID + 1 + count * args.users, ADMIN_ID + 1 + (count + 1) * args.users)
+        barrier = context.Barrier(count)
+        results = context.Queue()
+        processes = [context.Process(target=_shard_worker,
+                                     args=(db_path, i, count, user_ids, args.concurrency, barrier, results))
+                     for i in range(count)]
+        for process in processes:
+            process.start()
+        shards = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        updates = sum(s[0] for s in shards)
+        elapsed = max(s[2] for s in shards) - min(s[1] for s in shards)
+        print(f"{count:>2} workers: {updates} updates in {elapsed:.2f}s: {updates / elapsed:.0f} updates/s")
+
+# Micro-benchmark of callback dispatch cost against the number of registered actions
+async def run_dispatch(args):
+    from router import Router
+
+    async def noop(event, *args):
+        pass
+
+    for size in (10, 100, 1000):
+        router = Router(None)
+        for i in range(size):
+            router.callback(f"action{i}")(noop)
+        event = FakeEvent(2, data=f"action{size - 1}:42:7".encode())
+        for _ in range(1000):
+            await router.on_callback(event)
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            await router.on_callback(event)
+        per_call = (time.perf_counter() - start) / args.iterations
+        print(f"{size:>5} actions: {per_call * 1e6:.2f} us per callback")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--products', type=int, default=50)
+    parser.add_argument('--dispatch', action='store_true', help="benchmark router dispatch only")
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--writes', action='store_true', help="benchmark batched against per-call commits")
+    parser.add_argument('--pool', action='store_true', help="benchmark database calls on the event loop against the pool")
+    parser.add_argument('--workers', type=int, default=0, help="benchmark 1..N worker processes")
+    args = parser.parse_args()
+    if args.workers:
+        run_workers(args)
+    elif args.dispatch:
+        asyncio.run(run_dispatch(args))
+    elif args.writes:
+        asyncio.run(run_writes(args))
+    elif args.pool:
+        asyncio.run(run_pool(args))
+    else:
+        asyncio.run(run_load(args))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+import logging
+import os
+
+from telethon import types
+from telethon.errors import FloodWaitError, MessageNotModifiedError, RPCError
+
+import catalog
+import media_store
+
+logger = logging.getLogger(__name__)
+
+# Telegram's copy of sent media, stored as "photo:<id>:<access_hash>:<file reference hex>"
+# or "document:...". A packed bot file id would be resent with an empty file reference.
+def pack_media(media):
+    for kind, item, cls in (('photo', getattr(media, 'photo', None), types.Photo),
+                            ('document', getattr(media, 'document', None), types.Document)):
+        if isinstance(item, cls):
+            return f"{kind}:{item.id}:{item.access_hash}:{item.file_reference.hex()}"
+    return None
+
+# Input media for a value from pack_media; raises ValueError for anything else
+# (including bot file ids stored by earlier versions)
+def unpack_media(value):
+    kind, media_id, access_hash, file_reference = value.split(':')
+    cls = {'photo': types.InputPhoto, 'document': types.InputDocument}.get(kind)
+    if cls is None:
+        raise ValueError(f"unknown media kind {kind!r}")
+    return cls(int(media_id), int(access_hash), bytes.fromhex(file_reference))
+
+# Local path or URL of the product's original media, if it can be sent
+def source_file(product):
+    for url in (product[4], product[5]):  # image_url, video_url
+        if url and (os.path.exists(url) or url.startswith(('http://', 'https://'))):
+            return url
+    return None
+
+# Edit the message to show the product, reusing the Telegram copy of its media
+# after the first upload instead of pushing the file again on every view
+async def edit_with_media(event, product, text, buttons):
+    product_id, stored = product[0], product[6]
+    if stored:
+        try:
+            return await event.edit(text, buttons=buttons, file=unpack_media(stored))
+        except (FloodWaitError, MessageNotModifiedError):
+            raise
+        except (ValueError, RPCError) as e:
+            # Expired or invalid reference, or an old-format id: drop it and upload again
+            logger.info(f"Stored media for product {product_id} unusable ({e}), uploading again")
+            await catalog.set_media_file_id(product_id, None)
+
+    file = source_file(product)
+    if not file:
+        return await event.edit(text, buttons=buttons)
+    final = True
+    if os.path.exists(file):
+        file, final = await media_store.preview_for(file)
+    try:
+        message = await event.edit(text, buttons=buttons, file=file)
+    except Exception as e:
+        logger.error(f"Failed to send media for product {product_id}: {e}")
+        return await event.edit(text, buttons=buttons)
+
+    # Keep uploading the original until its thumbnail is ready, then cache that instead
+    stored = pack_media(getattr(message, 'media', None))
+    if stored and final:
+        await catalog.set_media_file_id(product_id, stored)
+    return message
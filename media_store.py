@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:  # thumbnails are skipped without Pillow
+    Image = None
+
+import repository
+
+logger = logging.getLogger(__name__)
+
+MEDIA_DIR = os.getenv('MEDIA_DIR', 'media')
+THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', '640'))
+THUMBNAIL_QUALITY = int(os.getenv('THUMBNAIL_QUALITY', '80'))
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', '2'))
+
+_pool = None
+# Digests whose thumbnail is still being generated in this process
+pending_thumbnails = set()
+
+# File-like target for download_media that hashes and counts bytes as they stream in
+class _HashingWriter:
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+def _path_for(digest, ext):
+    return os.path.join(MEDIA_DIR, digest[:2], digest + ext)
+
+def _store(tmp_path, digest, ext):
+    path = _path_for(digest, ext)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+        return path, False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+    return path, True
+
+# Runs in a worker process
+def _make_thumbnail(src, dst, size, quality):
+    with Image.open(src) as image:
+        image.thumbnail((size, size))
+        image.convert('RGB').save(dst, 'JPEG', quality=quality, optimize=True)
+    return dst
+
+# Download a message's media into the content-addressed store, returning
+# (path, mime_type, size). Identical files share one copy on disk.
+async def save_message_media(message):
+    mime_type = (message.file and message.file.mime_type) or 'application/octet-stream'
+    ext = (message.file and message.file.ext) or mimetypes.guess_extension(mime_type) or ''
+    tmp_dir = os.path.join(MEDIA_DIR, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, f"{message.chat_id}_{message.id}{ext}")
+    try:
+        with open(tmp_path, 'wb') as f:
+            writer = _HashingWriter(f)
+            await message.download_media(file=writer)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    digest = writer.sha256.hexdigest()
+    loop = asyncio.get_running_loop()
+    path, created = await loop.run_in_executor(None, _store, tmp_path, digest, ext)
+    await repository.add_media_file(digest, path, mime_type, writer.size)
+    if created:
+        logger.info(f"Stored media {path} ({mime_type}, {writer.size} bytes)")
+        if mime_type.startswith('image/'):
+            start_thumbnail(digest, path)
+    else:
+        logger.info(f"Reused stored media {path}")
+    return path, mime_type, writer.size
+
+def start_thumbnail(digest, path):
+    global _pool
+    if Image is None or digest in pending_thumbnails:
+        return
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+    pending_thumbnails.add(digest)
+    asyncio.get_running_loop().create_task(_generate_thumbnail(digest, path))
+
+async def _generate_thumbnail(digest, path):
+    dst = os.path.join(MEDIA_DIR, digest[:2], digest + '.thumb.jpg')
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(_pool, _make_thumbnail, path, dst, THUMBNAIL_SIZE, THUMBNAIL_QUALITY)
+        await repository.set_media_thumbnail(digest, dst)
+    except Exception as e:
+        logger.error(f"Failed to generate thumbnail for {path}: {e}")
+    finally:
+        pending_thumbnails.discard(digest)
+
+# Best file to show in catalog views: the thumbnail when there is one.
+# Returns (file, final) where final is False while a thumbnail is still coming.
+async def preview_for(path):
+    record = await repository.get_media_file_by_path(path)
+    if record is None:
+        return path, True
+    digest, thumb_path = record[0], record[4]
+    if thumb_path and os.path.exists(thumb_path):
+        return thumb_path, True
+    return path, digest not in pending_thumbnails
+
+def shutdown():
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
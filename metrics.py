@@ -0,0 +1,211 @@
+import asyncio
+import bisect
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))  # 0 disables the endpoint
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{n}="{v}"' for n, v in zip(names, values))
+    return '{' + pairs + '}'
+
+# Minimal Prometheus-style metrics; each metric keeps one value per label tuple
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels=(), callback=None):
+        super().__init__(name, help_text, labels)
+        self.callback = callback
+
+    def set(self, *label_values, value):
+        with self._lock:
+            self.values[label_values] = value
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def render(self):
+        if self.callback is not None:
+            yield f"{self.name} {self.callback()}"
+            return
+        yield from super().render()
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # label tuple -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, *label_values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        with self._lock:
+            values = [(label_values, list(series)) for label_values, series in self.values.items()]
+        for label_values, series in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.labels + ('le',), label_values + (bound,))} {cumulative}"
+            yield f"{self.name}_bucket{_labels(self.labels + ('le',), label_values + ('+Inf',))} {series[-1]}"
+            yield f"{self.name}_sum{_labels(self.labels, label_values)} {series[-2]}"
+            yield f"{self.name}_count{_labels(self.labels, label_values)} {series[-1]}"
+
+_registry = []
+
+def _register(metric):
+    _registry.append(metric)
+    return metric
+
+def counter(name, help_text, labels=()):
+    return _register(Counter(name, help_text, labels))
+
+def gauge(name, help_text, labels=(), callback=None):
+    return _register(Gauge(name, help_text, labels, callback))
+
+def histogram(name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram(name, help_text, labels, buckets))
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+handler_latency = histogram('bot_handler_seconds', "Handler latency", ('handler',))
+handler_errors = counter('bot_handler_errors_total', "Handlers that raised", ('handler',))
+updates_in_flight = gauge('bot_updates_in_flight', "Updates being handled")
+db_latency = histogram('bot_db_query_seconds', "database.py call duration, excluding pool wait", ('query',))
+db_errors = counter('bot_db_errors_total', "database.py calls that raised", ('query',))
+telegram_latency = histogram('bot_telegram_request_seconds', "Outbound Telegram API request duration", ('request',))
+telegram_errors = counter('bot_telegram_errors_total', "Outbound Telegram API requests that failed", ('request', 'error'))
+loop_lag = histogram('bot_event_loop_lag_seconds', "Delay of a timer wakeup on the event loop")
+
+# Time a handler call for update dispatch
+async def track_handler(name, handler, *args):
+    updates_in_flight.inc()
+    start = time.perf_counter()
+    try:
+        return await handler(*args)
+    except Exception:
+        handler_errors.inc(name)
+        raise
+    finally:
+        handler_latency.observe(name, value=time.perf_counter() - start)
+        updates_in_flight.dec()
+
+# Time a database.py call; runs inside the pool thread
+def track_query(func, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        db_errors.inc(func.__name__)
+        raise
+    finally:
+        db_latency.observe(func.__name__, value=time.perf_counter() - start)
+
+# Time an outbound Telegram request made through TelegramClient.__call__
+async def track_request(call, request, *args, **kwargs):
+    name = type(request).__name__
+    start = time.perf_counter()
+    try:
+        return await call(request, *args, **kwargs)
+    except Exception as e:
+        telegram_errors.inc(name, type(e).__name__)
+        raise
+    finally:
+        telegram_latency.observe(name, value=time.perf_counter() - start)
+
+async def _monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag.observe(value=max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
+
+async def _serve(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        if request_line.split(b' ')[1:2] == [b'/metrics']:
+            body = render().encode()
+            status = b'200 OK'
+        else:
+            body = b'Not found\n'
+            status = b'404 Not Found'
+        writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+        await writer.drain()
+    except Exception as e:
+        logger.error(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+_tasks = []
+_server = None
+
+# Start the loop lag monitor and the local /metrics endpoint
+async def start():
+    global _server
+    _tasks.append(asyncio.create_task(_monitor_loop_lag()))
+    if METRICS_PORT:
+        _server = await asyncio.start_server(_serve, METRICS_HOST, METRICS_PORT)
+        logger.info(f"Metrics available at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def stop():
+    global _server
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
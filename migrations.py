@@ -0,0 +1,287 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Schema steps in order. Each runs once, inside its own transaction, and the
+# number of applied steps is stored in schema_version. Append new steps at the
+# end; never edit or reorder one that has shipped.
+
+def _create_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS products
+                 (id INTEGER PRIMARY KEY, name TEXT, price REAL, description TEXT, image_url TEXT, video_url TEXT, media_file_id TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS orders
+                 (id INTEGER PRIMARY KEY, user_id INTEGER, product_id INTEGER, quantity INTEGER, status TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                 (user_id INTEGER PRIMARY KEY, phone_number TEXT, is_verified INTEGER DEFAULT 0)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS news
+                 (id INTEGER PRIMARY KEY, content TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcasts
+                 (id INTEGER PRIMARY KEY, content TEXT, admin_id INTEGER, status TEXT DEFAULT 'running', last_user_id INTEGER DEFAULT 0, sent INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcast_deliveries
+                 (broadcast_id INTEGER, user_id INTEGER, status TEXT, error TEXT, PRIMARY KEY (broadcast_id, user_id))''')
+
+    # Databases created before these columns existed
+    c.execute("PRAGMA table_info(products)")
+    columns = [col[1] for col in c.fetchall()]
+    if 'video_url' not in columns:
+        c.execute("ALTER TABLE products ADD COLUMN video_url TEXT")
+    if 'media_file_id' not in columns:
+        c.execute("ALTER TABLE products ADD COLUMN media_file_id TEXT")
+
+def _add_indexes(c):
+    # get_user_orders and the per-user order pages
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders (user_id, id)")
+    # status-filtered order pages
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, id)")
+    # orders JOIN products, and ON DELETE actions on products
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_product_id ON orders (product_id)")
+    # get_news ORDER BY created_at DESC
+    c.execute("CREATE INDEX IF NOT EXISTS idx_news_created_at ON news (created_at)")
+
+def _add_order_foreign_keys(c):
+    # SQLite can't add constraints in place, so rebuild orders. Orders of deleted
+    # products keep their history with product_id set to NULL.
+    c.execute('''CREATE TABLE orders_new
+                 (id INTEGER PRIMARY KEY,
+                  user_id INTEGER REFERENCES users (user_id) ON DELETE CASCADE,
+                  product_id INTEGER REFERENCES products (id) ON DELETE SET NULL,
+                  quantity INTEGER, status TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute('''INSERT INTO orders_new (id, user_id, product_id, quantity, status, created_at)
+                 SELECT o.id, o.user_id, p.id, o.quantity, o.status, o.created_at
+                 FROM orders o LEFT JOIN products p ON p.id = o.product_id''')
+    c.execute("DROP TABLE orders")
+    c.execute("ALTER TABLE orders_new RENAME TO orders")
+    _add_indexes(c)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_user ON broadcast_deliveries (user_id)")
+
+def _add_conversation_states(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS conversation_states
+                 (user_id INTEGER PRIMARY KEY, data TEXT, expires_at REAL)''')
+
+def _add_cart_items(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS cart_items
+                 (user_id INTEGER REFERENCES users (user_id) ON DELETE CASCADE,
+                  product_id INTEGER REFERENCES products (id) ON DELETE CASCADE,
+                  quantity INTEGER NOT NULL,
+                  added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  PRIMARY KEY (user_id, product_id))''')
+
+def _add_user_stats(c):
+    # Per-user aggregates maintained by triggers on orders, so every write path
+    # (single orders, checkout, imports) keeps them current
+    c.execute('''CREATE TABLE IF NOT EXISTS user_stats
+                 (user_id INTEGER PRIMARY KEY REFERENCES users (user_id) ON DELETE CASCADE,
+                  order_count INTEGER NOT NULL DEFAULT 0,
+                  total_spent REAL NOT NULL DEFAULT 0,
+                  last_order_at TIMESTAMP)''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS user_stats_order_insert AFTER INSERT ON orders
+                 BEGIN
+                     INSERT INTO user_stats (user_id, order_count, total_spent, last_order_at)
+                     VALUES (NEW.user_id, 1,
+                             NEW.quantity * COALESCE((SELECT price FROM products WHERE id = NEW.product_id), 0),
+                             NEW.created_at)
+                     ON CONFLICT (user_id) DO UPDATE SET
+                         order_count = order_count + 1,
+                         total_spent = total_spent + excluded.total_spent,
+                         last_order_at = MAX(COALESCE(last_order_at, excluded.last_order_at), excluded.last_order_at);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS user_stats_order_delete AFTER DELETE ON orders
+                 BEGIN
+                     UPDATE user_stats SET
+                         order_count = order_count - 1,
+                         total_spent = total_spent - OLD.quantity * COALESCE((SELECT price FROM products WHERE id = OLD.product_id), 0)
+                     WHERE user_id = OLD.user_id;
+                 END''')
+    c.execute('''INSERT OR REPLACE INTO user_stats (user_id, order_count, total_spent, last_order_at)
+                 SELECT o.user_id, COUNT(*), COALESCE(SUM(o.quantity * p.price), 0), MAX(o.created_at)
+                 FROM orders o LEFT JOIN products p ON p.id = o.product_id
+                 GROUP BY o.user_id''')
+
+def _add_media_files(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS media_files
+                 (sha256 TEXT PRIMARY KEY, path TEXT NOT NULL, mime_type TEXT, size INTEGER,
+                  thumb_path TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_media_files_path ON media_files (path)")
+
+# External-content FTS5 index over product names and descriptions, kept in
+# sync by triggers so every write path (including bulk ones) updates it
+def _add_product_search(c):
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5
+                 (name, description, content='products', content_rowid='id',
+                  tokenize='unicode61 remove_diacritics 2', prefix='2 3')''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products
+                 BEGIN
+                     INSERT INTO products_fts (rowid, name, description) VALUES (NEW.id, NEW.name, NEW.description);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products
+                 BEGIN
+                     INSERT INTO products_fts (products_fts, rowid, name, description) VALUES ('delete', OLD.id, OLD.name, OLD.description);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, description ON products
+                 BEGIN
+                     INSERT INTO products_fts (products_fts, rowid, name, description) VALUES ('delete', OLD.id, OLD.name, OLD.description);
+                     INSERT INTO products_fts (rowid, name, description) VALUES (NEW.id, NEW.name, NEW.description);
+                 END''')
+    c.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+# Stable product key for bulk upserts, and removal of exact duplicate products
+# left by the old unconditional startup seeding (only those no order or cart uses).
+# Products created without a sku get 'product-<id>' so exports can be re-imported.
+def _add_product_sku(c):
+    c.execute("ALTER TABLE products ADD COLUMN sku TEXT")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_products_sku ON products (sku) WHERE sku IS NOT NULL")
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_default_sku AFTER INSERT ON products
+                 WHEN NEW.sku IS NULL
+                 BEGIN
+                     UPDATE products SET sku = 'product-' || NEW.id WHERE id = NEW.id;
+                 END''')
+    c.execute('''DELETE FROM products WHERE id IN (
+                     SELECT p.id FROM products p
+                     WHERE EXISTS (SELECT 1 FROM products d
+                                   WHERE d.id < p.id AND d.name = p.name AND d.price = p.price
+                                   AND d.description IS p.description AND d.image_url IS p.image_url
+                                   AND d.video_url IS p.video_url)
+                     AND NOT EXISTS (SELECT 1 FROM orders o WHERE o.product_id = p.id)
+                     AND NOT EXISTS (SELECT 1 FROM cart_items ci WHERE ci.product_id = p.id))''')
+    c.execute("UPDATE products SET sku = 'product-' || id WHERE sku IS NULL")
+
+# Trigger statements adding (sign 1) or removing (sign -1) one order row from both rollups
+def _sales_upserts(row, sign):
+    values = f"{sign}, {sign} * {row}.quantity, {sign} * {row}.quantity * COALESCE({row}.unit_price, 0)"
+    return f'''INSERT INTO sales_by_product (product_id, status, order_count, units, revenue)
+               VALUES (COALESCE({row}.product_id, 0), {row}.status, {values})
+               ON CONFLICT (product_id, status) DO UPDATE SET
+                   order_count = order_count + excluded.order_count, units = units + excluded.units, revenue = revenue + excluded.revenue;
+               INSERT INTO sales_by_day (day, status, order_count, units, revenue)
+               VALUES (date({row}.created_at), {row}.status, {values})
+               ON CONFLICT (day, status) DO UPDATE SET
+                   order_count = order_count + excluded.order_count, units = units + excluded.units, revenue = revenue + excluded.revenue;'''
+
+# Sales rollups by (product, status) and (day, status), maintained by triggers
+# on orders. Revenue uses the price recorded on the order, so later price
+# changes don't rewrite history; product 0 collects orders of deleted products.
+def _add_sales_rollups(c):
+    c.execute("ALTER TABLE orders ADD COLUMN unit_price REAL")
+    c.execute("UPDATE orders SET unit_price = (SELECT price FROM products WHERE id = orders.product_id)")
+    c.execute('''CREATE TABLE IF NOT EXISTS sales_by_product
+                 (product_id INTEGER NOT NULL, status TEXT NOT NULL,
+                  order_count INTEGER NOT NULL DEFAULT 0, units INTEGER NOT NULL DEFAULT 0, revenue REAL NOT NULL DEFAULT 0,
+                  PRIMARY KEY (product_id, status))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sales_by_day
+                 (day TEXT NOT NULL, status TEXT NOT NULL,
+                  order_count INTEGER NOT NULL DEFAULT 0, units INTEGER NOT NULL DEFAULT 0, revenue REAL NOT NULL DEFAULT 0,
+                  PRIMARY KEY (day, status))''')
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS sales_order_insert AFTER INSERT ON orders
+                  BEGIN {_sales_upserts('NEW', 1)} END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS sales_order_delete AFTER DELETE ON orders
+                  BEGIN {_sales_upserts('OLD', -1)} END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS sales_order_update AFTER UPDATE OF product_id, quantity, status, unit_price ON orders
+                  BEGIN {_sales_upserts('OLD', -1)} {_sales_upserts('NEW', 1)} END""")
+    fill_sales_rollups(c)
+
+# Recompute the sales rollups from the orders table
+def fill_sales_rollups(c):
+    c.execute("DELETE FROM sales_by_product")
+    c.execute("DELETE FROM sales_by_day")
+    c.execute('''INSERT INTO sales_by_product (product_id, status, order_count, units, revenue)
+                 SELECT COALESCE(product_id, 0), status, COUNT(*), SUM(quantity), SUM(quantity * COALESCE(unit_price, 0))
+                 FROM orders GROUP BY COALESCE(product_id, 0), status''')
+    c.execute('''INSERT INTO sales_by_day (day, status, order_count, units, revenue)
+                 SELECT date(created_at), status, COUNT(*), SUM(quantity), SUM(quantity * COALESCE(unit_price, 0))
+                 FROM orders GROUP BY date(created_at), status''')
+
+# Counter bumped by every change to products, so processes that cache the
+# catalog can notice writes made by other processes
+def _add_catalog_version(c):
+    c.execute("CREATE TABLE IF NOT EXISTS catalog_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)")
+    c.execute("INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS catalog_version_{event.lower()} AFTER {event} ON products
+                      BEGIN
+                          UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+                      END''')
+
+# Append-only record of user and admin actions, written in batches by activity.py
+def _add_activity_log(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS activity_log
+                 (id INTEGER PRIMARY KEY, created_at REAL NOT NULL, user_id INTEGER, action TEXT NOT NULL,
+                  detail TEXT, sample_rate REAL NOT NULL DEFAULT 1)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_activity_log_user ON activity_log (user_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_activity_log_action ON activity_log (action, created_at)")
+
+# Trigger statement adding (sign 1) or removing (sign -1) one order row from its user's stats
+def _user_stats_change(row, sign):
+    placed = f"({row}.status IS NOT 'cancelled')"
+    return f'''UPDATE user_stats SET
+                   order_count = order_count + {sign} * {placed},
+                   total_spent = total_spent + {sign} * {placed} * {row}.quantity * COALESCE({row}.unit_price, 0)
+               WHERE user_id = {row}.user_id;'''
+
+# The user_stats triggers predate order statuses and unit_price: count only
+# orders that aren't cancelled, at the price recorded on the order
+def _fix_user_stats(c):
+    c.execute("DROP TRIGGER IF EXISTS user_stats_order_insert")
+    c.execute("DROP TRIGGER IF EXISTS user_stats_order_delete")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS user_stats_order_insert AFTER INSERT ON orders
+                  BEGIN
+                      INSERT INTO user_stats (user_id, order_count, total_spent, last_order_at)
+                      VALUES (NEW.user_id, 0, 0, NEW.created_at)
+                      ON CONFLICT (user_id) DO UPDATE SET
+                          last_order_at = MAX(COALESCE(last_order_at, excluded.last_order_at), excluded.last_order_at);
+                      {_user_stats_change('NEW', 1)}
+                  END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS user_stats_order_delete AFTER DELETE ON orders
+                  BEGIN {_user_stats_change('OLD', -1)} END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS user_stats_order_update AFTER UPDATE OF user_id, quantity, status, unit_price ON orders
+                  BEGIN {_user_stats_change('OLD', -1)} {_user_stats_change('NEW', 1)} END""")
+    c.execute("DELETE FROM user_stats")
+    c.execute('''INSERT INTO user_stats (user_id, order_count, total_spent, last_order_at)
+                 SELECT user_id, SUM(status IS NOT 'cancelled'),
+                        SUM((status IS NOT 'cancelled') * quantity * COALESCE(unit_price, 0)), MAX(created_at)
+                 FROM orders WHERE user_id IS NOT NULL GROUP BY user_id''')
+
+MIGRATIONS = [
+    _create_tables,
+    _add_indexes,
+    _add_order_foreign_keys,
+    _add_conversation_states,
+    _add_cart_items,
+    _add_user_stats,
+    _add_media_files,
+    _add_product_search,
+    _add_product_sku,
+    _add_sales_rollups,
+    _add_catalog_version,
+    _add_activity_log,
+    _fix_user_stats,
+]
+
+def get_version(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    row = conn.execute("SELECT version FROM schema_version").fetchone()
+    return row[0] if row else 0
+
+def migrate(conn):
+    version = get_version(conn)
+    if version >= len(MIGRATIONS):
+        return
+    # Table rebuilds must not trigger foreign key actions; the pragma is a no-op inside a transaction
+    conn.execute("PRAGMA foreign_keys=OFF")
+    try:
+        for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+            c = conn.cursor()
+            c.execute("BEGIN")
+            try:
+                step(c)
+                c.execute("DELETE FROM schema_version")
+                c.execute("INSERT INTO schema_version (version) VALUES (?)", (number,))
+                violations = c.execute("PRAGMA foreign_key_check").fetchall()
+                if violations:
+                    logger.warning(f"Migration {number} left {len(violations)} foreign key violations")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            logger.info(f"Applied migration {number}: {step.__name__.lstrip('_')}")
+    finally:
+        conn.execute("PRAGMA foreign_keys=ON")
@@ -0,0 +1,219 @@
+import asyncio
+import collections
+import contextvars
+import logging
+import os
+
+from telethon import utils
+from telethon.errors import FloodWaitError
+from telethon.tl.functions.messages import (
+    EditMessageRequest, ForwardMessagesRequest, SendMediaRequest, SendMessageRequest, SendMultiMediaRequest,
+)
+
+import metrics
+from ratelimit import TokenBuckets
+
+logger = logging.getLogger(__name__)
+
+# Telegram's documented bot limits: about 30 messages per second overall, one
+# per second in a private chat (short bursts are tolerated), 20 per minute in a group
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '30'))
+OUTBOX_GLOBAL_BURST = float(os.getenv('OUTBOX_GLOBAL_BURST', '30'))
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', '1'))
+OUTBOX_CHAT_BURST = float(os.getenv('OUTBOX_CHAT_BURST', '3'))
+OUTBOX_GROUP_RATE = float(os.getenv('OUTBOX_GROUP_RATE', str(20 / 60)))
+OUTBOX_GROUP_BURST = float(os.getenv('OUTBOX_GROUP_BURST', '3'))
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', '8'))
+OUTBOX_FLOOD_RETRIES = int(os.getenv('OUTBOX_FLOOD_RETRIES', '3'))
+
+# Requests that count against Telegram's send limits; everything else
+# (callback answers, inline results, uploads, reads) bypasses the scheduler
+SCHEDULED_REQUESTS = (SendMessageRequest, SendMediaRequest, SendMultiMediaRequest, ForwardMessagesRequest, EditMessageRequest)
+
+INTERACTIVE, BACKGROUND = 0, 1
+PRIORITY_NAMES = ('interactive', 'background')
+
+# Priority for sends made in the current context; background workers set BACKGROUND
+priority = contextvars.ContextVar('outbox_priority', default=INTERACTIVE)
+
+queue_depth = metrics.gauge('bot_outbox_queue_depth', "Sends and edits waiting in the outbox", ('priority',))
+queue_wait = metrics.histogram('bot_outbox_wait_seconds', "Time from queueing to sending", ('priority',))
+coalesced_edits = metrics.counter('bot_outbox_coalesced_edits_total', "Edits replaced by a newer edit of the same message")
+flood_waits = metrics.counter('bot_outbox_flood_waits_total', "FloodWait errors returned by Telegram")
+
+def _chat_of(request):
+    try:
+        return utils.get_peer_id(request.peer)
+    except (TypeError, AttributeError):
+        return None
+
+class _Item:
+    __slots__ = ('request', 'ordered', 'chat', 'edit_key', 'priority', 'futures', 'queued_at', 'attempts')
+
+    def __init__(self, request, ordered, chat, edit_key, priority, future, queued_at):
+        self.request = request
+        self.ordered = ordered
+        self.chat = chat
+        self.edit_key = edit_key
+        self.priority = priority
+        self.futures = [future]
+        self.queued_at = queued_at
+        self.attempts = 0
+
+# Single scheduler for outbound sends and edits. Items wait in one queue per
+# priority; the dispatcher takes the first interactive item whose chat has a
+# token, falling back to background items, then waits for the global bucket.
+# Messages to one chat keep their order, a queued edit is replaced by a newer
+# edit of the same message, and a FloodWait pauses all sending before a retry.
+class Outbox:
+    def __init__(self, send, global_rate=OUTBOX_GLOBAL_RATE, global_burst=OUTBOX_GLOBAL_BURST):
+        self.send = send
+        self.queues = (collections.deque(), collections.deque())
+        self._edits = {}  # (chat, message id) -> queued edit
+        self._chat_buckets = TokenBuckets(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+        self._group_buckets = TokenBuckets(OUTBOX_GROUP_RATE, OUTBOX_GROUP_BURST)
+        self._global_bucket = TokenBuckets(global_rate, global_burst)
+        self._busy_chats = set()
+        self._in_flight = set()
+        self._pause_until = 0.0
+        self._wake = None
+        self._slots = None
+        self._task = None
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    async def submit(self, request, ordered=False):
+        loop = asyncio.get_running_loop()
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._slots = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+            self._task = loop.create_task(self._run())
+        chat = _chat_of(request)
+        future = loop.create_future()
+        edit_key = (chat, request.id) if isinstance(request, EditMessageRequest) else None
+        queued = self._edits.get(edit_key) if edit_key else None
+        if queued is not None:
+            # Only the latest text matters; every caller gets the final result
+            queued.request = request
+            queued.futures.append(future)
+            coalesced_edits.inc()
+            return await future
+        item = _Item(request, ordered, chat, edit_key, priority.get(), future, loop.time())
+        if edit_key:
+            self._edits[edit_key] = item
+        self.queues[item.priority].append(item)
+        self._update_depth(item.priority)
+        self._wake.set()
+        return await future
+
+    def _update_depth(self, level):
+        queue_depth.set(PRIORITY_NAMES[level], value=len(self.queues[level]))
+
+    def _bucket_wait(self, chat):
+        # Negative peer ids are groups and channels
+        buckets = self._group_buckets if chat is not None and chat < 0 else self._chat_buckets
+        return buckets.take(chat)
+
+    # First item whose chat may send now, or (None, seconds until one might)
+    def _next_ready(self):
+        soonest = None
+        for queue in self.queues:
+            blocked = set(self._busy_chats)
+            for item in queue:
+                if item.chat in blocked:
+                    continue
+                wait = self._bucket_wait(item.chat)
+                if not wait:
+                    queue.remove(item)
+                    self._update_depth(item.priority)
+                    if item.edit_key:
+                        self._edits.pop(item.edit_key, None)
+                    return item, None
+                blocked.add(item.chat)  # keep later messages to this chat behind it
+                soonest = wait if soonest is None else min(soonest, wait)
+        return None, soonest
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item, wait = self._next_ready()
+            if item is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._busy_chats.add(item.chat)
+            await self._slots.acquire()
+            while True:
+                wait = self._pause_until - loop.time()
+                if wait <= 0:
+                    wait = self._global_bucket.take(None)
+                    if not wait:
+                        break
+                await asyncio.sleep(wait)
+            queue_wait.observe(PRIORITY_NAMES[item.priority], value=loop.time() - item.queued_at)
+            task = loop.create_task(self._send(item))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, item):
+        loop = asyncio.get_running_loop()
+        try:
+            result = await self.send(item.request, item.ordered, 0)
+        except FloodWaitError as e:
+            flood_waits.inc()
+            item.attempts += 1
+            if item.attempts > OUTBOX_FLOOD_RETRIES:
+                self._finish(item, error=e)
+                return
+            backoff = e.seconds + 2 ** (item.attempts - 1)
+            logger.warning(f"Flood wait of {e.seconds}s, pausing sends for {backoff}s")
+            self._pause_until = max(self._pause_until, loop.time() + backoff)
+            self._requeue(item)
+        except asyncio.CancelledError:
+            self._finish(item, error=ConnectionError("outbox stopped"))
+            raise
+        except Exception as e:
+            self._finish(item, error=e)
+        else:
+            self._finish(item, result=result)
+        finally:
+            self._busy_chats.discard(item.chat)
+            self._slots.release()
+            self._wake.set()
+
+    def _requeue(self, item):
+        newer = self._edits.get(item.edit_key) if item.edit_key else None
+        if newer is not None:
+            newer.futures.extend(item.futures)
+            return
+        if item.edit_key:
+            self._edits[item.edit_key] = item
+        self.queues[item.priority].appendleft(item)
+        self._update_depth(item.priority)
+
+    def _finish(self, item, result=None, error=None):
+        for future in item.futures:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        for task in list(self._in_flight):
+            task.cancel()
+        await asyncio.gather(self._task, *self._in_flight, return_exceptions=True)
+        self._task = None
+        for level, queue in enumerate(self.queues):
+            while queue:
+                self._finish(queue.popleft(), error=ConnectionError("outbox stopped"))
+            self._update_depth(level)
+        self._edits.clear()
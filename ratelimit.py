@@ -0,0 +1,79 @@
+import os
+import time
+
+import metrics
+
+RATE_LIMIT_RATE = float(os.getenv('RATE_LIMIT_RATE', '3'))  # taps per second per user
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', '8'))
+GLOBAL_RATE_LIMIT = float(os.getenv('GLOBAL_RATE_LIMIT', '300'))  # updates per second for the whole bot
+GLOBAL_RATE_BURST = float(os.getenv('GLOBAL_RATE_BURST', '600'))
+RATE_LIMIT_SWEEP_INTERVAL = float(os.getenv('RATE_LIMIT_SWEEP_INTERVAL', '60'))
+
+limited = metrics.counter('bot_rate_limited_total', "Updates held back by the rate limiter", ('action', 'outcome'))
+
+# Token buckets sharing one rate and burst, one per key. A bucket is just
+# [tokens, last update]; buckets that have refilled completely behave exactly
+# like missing ones, so they are evicted on a periodic sweep.
+class TokenBuckets:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._next_sweep = time.monotonic() + RATE_LIMIT_SWEEP_INTERVAL
+
+    def __len__(self):
+        return len(self._buckets)
+
+    # Take one token; returns 0 when allowed, otherwise seconds until a token is available
+    def take(self, key):
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self.sweep(now)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) / self.rate
+
+    def sweep(self, now=None):
+        now = time.monotonic() if now is None else now
+        full = [key for key, (tokens, updated) in self._buckets.items()
+                if tokens + (now - updated) * self.rate >= self.burst]
+        for key in full:
+            del self._buckets[key]
+        self._next_sweep = now + RATE_LIMIT_SWEEP_INTERVAL
+
+# Limit for one action. Over-limit taps are dropped, or with coalesce=True the
+# latest one is kept and handled once a token frees up, replacing earlier ones.
+class Policy:
+    def __init__(self, rate, burst, coalesce=False):
+        self.buckets = TokenBuckets(rate, burst)
+        self.coalesce = coalesce
+
+# Per-user buckets (per action policy, default otherwise) in front of one global bucket
+class RateLimiter:
+    def __init__(self, default=None, global_rate=GLOBAL_RATE_LIMIT, global_burst=GLOBAL_RATE_BURST, exempt=()):
+        self.default = default or Policy(RATE_LIMIT_RATE, RATE_LIMIT_BURST)
+        self.policies = {}
+        self.exempt = set(exempt)
+        self.global_buckets = TokenBuckets(global_rate, global_burst)
+
+    def policy(self, action):
+        return self.policies.get(action, self.default)
+
+    # Returns 0 when the update may run now, otherwise seconds to wait
+    def check(self, user_id, action):
+        if user_id in self.exempt:
+            return 0
+        wait = self.policy(action).buckets.take(user_id)
+        if wait:
+            return wait
+        return self.global_buckets.take(None)
+
+    def __len__(self):
+        return len(self.default.buckets) + sum(len(p.buckets) for p in self.policies.values())
@@ -0,0 +1,75 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import metrics
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+
+# Every pool thread keeps its own long-lived connection (see database.get_connection),
+# so queries run off the event loop without reconnecting on each call
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db')
+
+async def run(func, *args, **kwargs):
+    # Run in the caller's context so context variables reach the pool thread,
+    # rolling back a failed call so the thread's connection is left clean
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _executor, functools.partial(context.run, database.call, metrics.track_query, func, *args, **kwargs)
+    )
+
+def _async(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+def shutdown():
+    _executor.shutdown(wait=True)
+
+init_db = _async(database.init_db)
+add_product = _async(database.add_product)
+update_product = _async(database.update_product)
+delete_product = _async(database.delete_product)
+get_products = _async(database.get_products)
+add_media_file = _async(database.add_media_file)
+get_media_file_by_path = _async(database.get_media_file_by_path)
+set_media_thumbnail = _async(database.set_media_thumbnail)
+get_products_after = _async(database.get_products_after)
+search_products = _async(database.search_products)
+get_catalog_version = _async(database.get_catalog_version)
+upsert_products = _async(database.upsert_products)
+seed_products = _async(database.seed_products)
+export_products = _async(database.export_products)
+get_products_before = _async(database.get_products_before)
+get_product = _async(database.get_product)
+set_product_media_file_id = _async(database.set_product_media_file_id)
+remove_from_cart = _async(database.remove_from_cart)
+clear_cart = _async(database.clear_cart)
+get_cart = _async(database.get_cart)
+checkout_cart = _async(database.checkout_cart)
+get_user_orders = _async(database.get_user_orders)
+get_recent_orders = _async(database.get_recent_orders)
+get_user_activity = _async(database.get_user_activity)
+update_order_status = _async(database.update_order_status)
+get_sales_by_status = _async(database.get_sales_by_status)
+get_top_products = _async(database.get_top_products)
+get_daily_sales = _async(database.get_daily_sales)
+rebuild_sales_rollups = _async(database.rebuild_sales_rollups)
+get_user_stats = _async(database.get_user_stats)
+get_orders_page = _async(database.get_orders_page)
+export_orders_csv = _async(database.export_orders_csv)
+get_user = _async(database.get_user)
+get_news = _async(database.get_news)
+get_all_users = _async(database.get_all_users)
+create_broadcast = _async(database.create_broadcast)
+get_running_broadcasts = _async(database.get_running_broadcasts)
+get_broadcast_batch = _async(database.get_broadcast_batch)
+record_broadcast_batch = _async(database.record_broadcast_batch)
+finish_broadcast = _async(database.finish_broadcast)
+load_conversation_states = _async(database.load_conversation_states)
+save_conversation_states = _async(database.save_conversation_states)
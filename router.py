@@ -0,0 +1,137 @@
+import asyncio
+import logging
+
+from telethon import events
+
+import metrics
+import ratelimit
+
+logger = logging.getLogger(__name__)
+
+# Callback data is "action" or "action:arg1:arg2", parsed once per update and
+# routed with a dict lookup instead of matching each handler's regex in turn.
+def encode(action, *args):
+    return ':'.join((action,) + tuple(str(arg) for arg in args))
+
+def parse(data):
+    action, *args = data.decode().split(':')
+    return action, args
+
+# Single entry point for all updates. Callback queries are routed by action,
+# slash commands by name, and other messages by the sender's conversation
+# (state, step), so each flow is an explicit state machine. An optional
+# RateLimiter is checked before any handler runs.
+class Router:
+    def __init__(self, state_store, limiter=None):
+        self.state_store = state_store
+        self.limiter = limiter
+        self.callbacks = {}
+        self.commands = {}
+        self.states = {}
+        self.inline_handler = None
+        self._coalesced = {}  # (user_id, action) -> latest held (event, args)
+        self._tasks = set()
+
+    def callback(self, action):
+        def decorator(handler):
+            self.callbacks[action] = handler
+            return handler
+        return decorator
+
+    def command(self, name):
+        def decorator(handler):
+            self.commands[name] = handler
+            return handler
+        return decorator
+
+    def state(self, state, step=None):
+        def decorator(handler):
+            self.states[(state, step)] = handler
+            return handler
+        return decorator
+
+    def inline(self, handler):
+        self.inline_handler = handler
+        return handler
+
+    def attach(self, client):
+        client.add_event_handler(self.on_callback, events.CallbackQuery())
+        client.add_event_handler(self.on_message, events.NewMessage(incoming=True))
+        client.add_event_handler(self.on_inline, events.InlineQuery())
+
+    async def on_callback(self, event):
+        try:
+            action, args = parse(event.data)
+        except UnicodeDecodeError:
+            action, args = None, ()
+        handler = self.callbacks.get(action)
+        if handler is None:
+            await event.answer()
+            return
+        if self.limiter is not None:
+            wait = self.limiter.check(event.sender_id, action)
+            if wait:
+                await self._hold(event, action, args, handler, wait)
+                return
+        await metrics.track_handler(handler.__name__, handler, event, *args)
+
+    # Over-limit callback: drop it, or keep only the latest tap per user and
+    # action and handle that one when a token is available
+    async def _hold(self, event, action, args, handler, wait):
+        if not self.limiter.policy(action).coalesce:
+            ratelimit.limited.inc(action, 'dropped')
+            await event.answer("Too many requests, please slow down.")
+            return
+        key = (event.sender_id, action)
+        previous = self._coalesced.get(key)
+        self._coalesced[key] = (event, args)
+        if previous is not None:
+            ratelimit.limited.inc(action, 'coalesced')
+            await previous[0].answer()
+            return
+        task = asyncio.get_running_loop().create_task(self._run_held(key, handler, wait))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_held(self, key, handler, wait):
+        user_id, action = key
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.limiter.check(user_id, action)
+        event, args = self._coalesced.pop(key)
+        ratelimit.limited.inc(action, 'delayed')
+        try:
+            await metrics.track_handler(handler.__name__, handler, event, *args)
+        except Exception as e:
+            logger.error(f"Delayed {action} for user {user_id} failed: {e}")
+
+    async def on_message(self, event):
+        text = (event.message.text or '').strip()
+        if self.limiter is not None:
+            action = text.split(' ', 1)[0].split('@', 1)[0] if text.startswith('/') else 'message'
+            if self.limiter.check(event.sender_id, action):
+                ratelimit.limited.inc(action, 'dropped')
+                return
+        if text.startswith('/'):
+            name, _, argument = text.partition(' ')
+            handler = self.commands.get(name.split('@', 1)[0])
+            if handler is not None:
+                await metrics.track_handler(handler.__name__, handler, event, argument.strip())
+                return
+        conversation = self.state_store.get(event.sender_id)
+        if conversation is None:
+            return
+        handler = self.states.get((conversation.state, conversation.step)) or self.states.get((conversation.state, None))
+        if handler is not None:
+            await metrics.track_handler(handler.__name__, handler, event, conversation, text)
+
+    async def on_inline(self, event):
+        handler = self.inline_handler
+        if handler is None:
+            await event.answer([])
+            return
+        if self.limiter is not None and self.limiter.check(event.sender_id, 'inline'):
+            ratelimit.limited.inc('inline', 'dropped')
+            await event.answer([], cache_time=0)
+            return
+        await metrics.track_handler(handler.__name__, handler, event, event.text.strip())
@@ -0,0 +1,144 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import repository
+
+logger = logging.getLogger(__name__)
+
+STATE_TTL = float(os.getenv('STATE_TTL', '900'))
+STATE_MAX_ENTRIES = int(os.getenv('STATE_MAX_ENTRIES', '50000'))
+STATE_SWEEP_INTERVAL = float(os.getenv('STATE_SWEEP_INTERVAL', '60'))
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', '5'))
+STATE_PERSIST = os.getenv('STATE_PERSIST', '1') == '1'
+
+# One user's position in a multi-step conversation (phone/OTP, admin product and news flows)
+class ConversationState:
+    __slots__ = ('state', 'step', 'otp', 'phone', 'name', 'price', 'description', 'field', 'product_id')
+
+    def __init__(self, state, **fields):
+        for slot in self.__slots__:
+            setattr(self, slot, fields.get(slot))
+        self.state = state
+
+    def to_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__ if getattr(self, slot) is not None}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+# Conversation states with a TTL and a size cap. Entries are kept in the order
+# they were last written, so expiry sweeps and eviction both pop from the front.
+# With persistence on, changes are written behind in batches so half-finished
+# flows survive a restart without a database write per message.
+class StateStore:
+    def __init__(self, ttl=STATE_TTL, max_entries=STATE_MAX_ENTRIES, persist=STATE_PERSIST, shard=(0, 1)):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.persist = persist
+        self.shard = shard  # (index, count): only users with user_id % count == index live here
+        self.evictions = 0
+        self._entries = OrderedDict()  # user_id -> (expires_at, ConversationState)
+        self._dirty = set()
+        self._tasks = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            self._remove(user_id)
+            return None
+        return entry[1]
+
+    def set(self, user_id, state):
+        self._entries[user_id] = (time.time() + self.ttl, state)
+        self._entries.move_to_end(user_id)
+        self._dirty.add(user_id)
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            self._dirty.add(evicted)
+            self.evictions += 1
+
+    def pop(self, user_id):
+        entry = self._entries.get(user_id)
+        self._remove(user_id)
+        return entry[1] if entry else None
+
+    def _remove(self, user_id):
+        if self._entries.pop(user_id, None) is not None:
+            self._dirty.add(user_id)
+
+    def sweep(self):
+        now = time.time()
+        expired = 0
+        while self._entries:
+            user_id, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at >= now:
+                break
+            self._remove(user_id)
+            expired += 1
+        return expired
+
+    async def load(self):
+        if not self.persist:
+            return
+        index, count = self.shard
+        for user_id, data, expires_at in await repository.load_conversation_states(time.time()):
+            if user_id % count != index:
+                continue
+            self._entries[user_id] = (expires_at, ConversationState.from_dict(json.loads(data)))
+        logger.info(f"Restored {len(self._entries)} conversation states")
+
+    async def flush(self):
+        if not self.persist or not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        upserts = []
+        deletes = []
+        for user_id in dirty:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                deletes.append((user_id,))
+            else:
+                upserts.append((user_id, json.dumps(entry[1].to_dict()), entry[0]))
+        try:
+            await repository.save_conversation_states(upserts, deletes)
+        except Exception as e:
+            logger.error(f"Failed to persist conversation states: {e}")
+            self._dirty |= dirty
+
+    async def start(self):
+        await self.load()
+        self._tasks = [asyncio.create_task(self._sweep_loop())]
+        if self.persist:
+            self._tasks.append(asyncio.create_task(self._flush_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(STATE_SWEEP_INTERVAL)
+            expired = self.sweep()
+            if expired:
+                logger.info(f"Expired {expired} conversation states")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            await self.flush()
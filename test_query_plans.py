@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+import database
+
+# Every hot query must be answered through its index rather than a table scan.
+# The statements are captured as the database functions run them, then
+# explained against a freshly migrated database.
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DB_PATH', str(tmp_path / 'shop.db'))
+    monkeypatch.setattr(database, '_local', threading.local())
+    database.init_db()
+    yield database.get_connection()
+    database.get_connection().close()
+
+@pytest.fixture
+def statements(db):
+    captured = []
+    db.set_trace_callback(captured.append)
+    yield captured
+    db.set_trace_callback(None)
+
+def plan(conn, sql):
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+
+def plan_of(conn, statements, keyword):
+    sql, = [s for s in statements if s.lstrip().upper().startswith(keyword)]
+    return plan(conn, sql)
+
+def test_user_orders_use_user_index(db, statements):
+    database.get_user_orders(5)
+    steps = plan_of(db, statements, 'SELECT')
+    assert "SEARCH o USING INDEX idx_orders_user_id (user_id=?)" in steps
+    assert "SEARCH p USING INTEGER PRIMARY KEY (rowid=?) LEFT-JOIN" in steps
+
+def test_recent_orders_use_user_index(db, statements):
+    database.get_recent_orders(5, 0, 10)
+    steps = plan_of(db, statements, 'SELECT')
+    assert "SEARCH o USING INDEX idx_orders_user_id (user_id=?)" in steps
+    assert not any("TEMP B-TREE" in step for step in steps)
+
+def test_recent_orders_page_seeks_by_id(db, statements):
+    database.get_recent_orders(5, 100, 10)
+    steps = plan_of(db, statements, 'SELECT')
+    assert "SEARCH o USING INDEX idx_orders_user_id (user_id=? AND id<?)" in steps
+    assert not any("TEMP B-TREE" in step for step in steps)
+
+def test_deleting_product_finds_orders_by_product_index(db, statements):
+    database.delete_product(1)
+    steps = plan_of(db, statements, 'DELETE')
+    assert "SEARCH orders USING COVERING INDEX idx_orders_product_id (product_id=?)" in steps
+
+def test_orders_page_by_status_uses_status_index(db, statements):
+    database.get_orders_page(100, 10, status='pending')
+    steps = plan_of(db, statements, 'SELECT')
+    assert any(step.startswith("SEARCH o USING INDEX idx_orders_status (status=?") for step in steps)
+    assert not any("TEMP B-TREE" in step for step in steps)
+
+def test_news_uses_created_at_index(db, statements):
+    database.get_news()
+    steps = plan_of(db, statements, 'SELECT')
+    assert steps == ["SCAN news USING INDEX idx_news_created_at"]
@@ -0,0 +1,120 @@
+import asyncio
+import contextvars
+import logging
+import os
+
+import database
+import metrics
+import repository
+
+logger = logging.getLogger(__name__)
+
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '256'))
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', '0'))
+
+batch_sizes = metrics.histogram('bot_write_batch_size', "Writes committed per transaction",
+                                buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+# Group commit for small, frequent inserts and updates. Writes from concurrent
+# handlers are committed together, one transaction per batch of up to
+# WRITE_BATCH_SIZE. With WRITE_FLUSH_INTERVAL at 0 a batch goes out as soon as
+# the writer is free, so writes arriving during one commit form the next batch;
+# a positive interval holds each batch back that long to gather more.
+# submit() returns a future that resolves once the write is committed, to the
+# row the statement returned (None for statements without RETURNING).
+class WriteQueue:
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, interval=WRITE_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending = []
+        self._wakeup = None
+        self._full = None
+        self._task = None
+        self._closed = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, name, *args):
+        if self._closed:
+            raise RuntimeError("write queue is stopped")
+        loop = asyncio.get_running_loop()
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._full = asyncio.Event()
+            # A fresh context, not the first caller's, for every batch the writer commits
+            self._task = loop.create_task(self._run(), context=contextvars.Context())
+        future = loop.create_future()
+        self._pending.append((name, args, contextvars.copy_context(), future))
+        self._wakeup.set()
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+        return future
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            if self.interval <= 0 or self._closed:
+                await asyncio.sleep(0)
+            else:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush()
+            if self._closed and not self._pending:
+                return
+
+    async def _flush(self):
+        batch = self._pending[:self.batch_size]
+        del self._pending[:self.batch_size]
+        if len(self._pending) < self.batch_size:
+            self._full.clear()
+        if not self._pending:
+            self._wakeup.clear()
+        if not batch:
+            return
+        try:
+            results = await repository.run(database.apply_writes, [write[:3] for write in batch])
+        except Exception as e:
+            logger.error(f"Failed to commit {len(batch)} queued writes: {e}")
+            results = [e] * len(batch)
+        batch_sizes.observe(value=len(batch))
+        for (name, args, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                logger.error(f"Queued write {name} failed: {result}")
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    # Commit everything still queued and stop accepting writes
+    async def stop(self):
+        self._closed = True
+        if self._task is None:
+            return
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+queue = WriteQueue()
+metrics.gauge('bot_write_queue_depth', "Writes waiting for the next group commit", callback=lambda: len(queue))
+
+def _queued(name):
+    async def write(*args):
+        await queue.submit(name, *args)
+    write.__name__ = name
+    return write
+
+# Add quantity of a product to the cart; the new quantity, or None if the product is gone
+async def add_to_cart(user_id, product_id, quantity=1):
+    row = await queue.submit('add_to_cart', user_id, product_id, quantity)
+    return row[0] if row else None
+
+add_user = _queued('add_user')
+verify_user = _queued('verify_user')
+add_news = _queued('add_news')
+
+async def stop():
+    await queue.stop()